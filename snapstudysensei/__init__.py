@@ -1,31 +1,56 @@
+import os
+import sys
+from concurrent.futures import ThreadPoolExecutor
+
+from snapstudysensei import trace
+
+
 def _init_ocr():
     print(":: initializing Optical Character Recognition")
-    from snapstudysensei.ocr import OCRWrapper
+    with trace.span("init.ocr"):
+        from snapstudysensei.ocr import OCRWrapper
 
-    return OCRWrapper()
+        # e.g. SSS_OCR_BACKEND=int8 on machines without a GPU
+        num_threads = os.environ.get("SSS_OCR_THREADS")
+        return OCRWrapper(
+            backend=os.environ.get("SSS_OCR_BACKEND", "default"),
+            num_threads=int(num_threads) if num_threads else None,
+        )
 
 
 def _init_dic():
     print(":: initializing dictionary")
-    from snapstudysensei.dic import JDictionary
+    with trace.span("init.dic"):
+        from snapstudysensei.dic import JDictionary
 
-    return JDictionary()
+        return JDictionary()
 
 
 def _init_tts():
     print(":: initializing Text-To-Speech")
-    from snapstudysensei.tts import TTSWrapper
+    with trace.span("init.tts"):
+        from snapstudysensei.tts import TTSWrapper
 
-    return TTSWrapper()
+        return TTSWrapper()
 
 
 def run():
-    # These initializations could be slow; having a special loading UI or
-    # splashscreen during their init might make sense
-    ocr = _init_ocr()
-    dic = _init_dic()
-    tts = _init_tts()
+    if sys.argv[1:2] == ["batch"]:
+        from snapstudysensei.batch import main as batch_main
+
+        return batch_main(sys.argv[2:])
+
+    # These initializations could be slow, so they are run concurrently in
+    # the background while the UI is loading; each feature is enabled in the
+    # UI once its backend is ready
+    executor = ThreadPoolExecutor(max_workers=3, thread_name_prefix="init")
+    backends = dict(
+        ocr=executor.submit(_init_ocr),
+        dic=executor.submit(_init_dic),
+        tts=executor.submit(_init_tts),
+    )
+    executor.shutdown(wait=False)
 
     from snapstudysensei.main import run as main_run
 
-    main_run(ocr, dic, tts)
+    main_run(backends)
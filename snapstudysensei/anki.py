@@ -1,10 +1,26 @@
 import base64
 import hashlib
+import http.client
 import json
+import os
 import re
-from dataclasses import asdict, dataclass
+import shutil
+import sqlite3
+import sys
+import threading
+import time
+import uuid
+from dataclasses import asdict, dataclass, fields
 from pathlib import Path
-from urllib.request import Request, urlopen
+from typing import Callable
+
+from xdg_base_dirs import xdg_cache_home, xdg_data_home
+
+from snapstudysensei import trace
+
+
+class AnkiError(Exception):
+    """Error returned by Anki for a request"""
 
 
 @dataclass
@@ -18,54 +34,144 @@ class AnkiNote:
     extra_info: str = ""
     anki_id: int = -1
 
-    def get_qml_record(self):
-        assert self.anki_id != -1
+    def get_qml_record(self, pending_id: str | None = None):
+        """Record for the QML; notes not yet in Anki are identified with their pending ID"""
+        assert self.anki_id != -1 or pending_id is not None
         reading = self.word_reading.replace("[", "「").replace("]", "」") if self.word_reading else self.word
+        record_id = pending_id if pending_id is not None else str(self.anki_id)
         return dict(
-            record_id=str(self.anki_id),  # QML doesn't support 64-bit integers (javascript bs)
+            record_id=record_id,  # QML doesn't support 64-bit integers (javascript bs)
             reading=reading,
             meaning=self.word_glossary,
+            pending=pending_id is not None,
         )
 
+    def to_dict(self) -> dict:
+        """Serializable form of the note"""
+        data = asdict(self)
+        data["context_picture"] = str(self.context_picture) if self.context_picture else None
+        data["word_audio"] = str(self.word_audio) if self.word_audio else None
+        return data
+
+    @classmethod
+    def from_dict(cls, data: dict):
+        note = cls(**data)
+        note.context_picture = Path(note.context_picture) if note.context_picture else None
+        note.word_audio = Path(note.word_audio) if note.word_audio else None
+        return note
+
 
 class AnkiConnect:
     PREFIX = "SnapStudySensei"
     DECK_NAME = f"Japanese::{PREFIX}"
     MODEL_NAME = f"{PREFIX} Word"
 
-    def __init__(self):
-        deck_ids = self.query("deckNamesAndIds")
-        deck_id = deck_ids.get(self.DECK_NAME)
-        if deck_id is None:
-            deck_id = self.query("createDeck", deck=self.DECK_NAME)
-
-        model_ids = self.query("modelNamesAndIds")
-        model_id = model_ids.get(self.MODEL_NAME)
-        if model_id is None:
-            tpl_dir = Path(__file__).resolve().parent / "data"
-            front = open(tpl_dir / "front.html").read()
-            back = open(tpl_dir / "back.html").read()
-            css = open(tpl_dir / "style.css").read()
-
-            model_id = self.query(
-                "createModel",
-                modelName=self.MODEL_NAME,
-                inOrderFields=[
-                    "Word",
-                    "ContextPicture",
-                    "ContextSentence",
-                    "WordReading",
-                    "WordGlossary",
-                    "WordAudio",
-                    "ExtraInfo",
-                ],
-                css=css,
-                cardTemplates=[dict(Front=front, Back=back)],
-            )
+    # Seconds to wait for Anki, which may be busy or hung; large batches of
+    # notes with their media take a while to be written
+    TIMEOUT = 30
+
+    def __init__(self, host: str = "localhost", port: int = 8765, timeout: float = TIMEOUT):
+        # A single keep-alive connection, shared by all the threads
+        self._conn = http.client.HTTPConnection(host, port, timeout=timeout)
+        self._conn_lock = threading.Lock()
+
+        # Our media files are content-addressed, so the ones already present
+        # in Anki don't need to be uploaded again. The hashes of the local
+        # files are cached between runs to avoid reading them again.
+        self._media_names: set[str] = set()
+        self._media_hashes_path = xdg_cache_home() / "SnapStudySensei" / "media_hashes.json"
+        self._media_hashes = self._load_media_hashes()
+        self._media_hashes_lock = threading.Lock()
+
+        # Anki may not be running yet: the deck, model and media are checked
+        # on the first request
+        self.media_dir_path: Path | None = None
+        self._ready = False
+        self._setup_lock = threading.Lock()
 
-        self.media_dir_path = Path(self.query("getMediaDirPath"))
+    def _setup(self):
+        if self._ready:
+            return
+        with self._setup_lock:
+            if self._ready:
+                return
+            actions = [
+                ("deckNamesAndIds", {}),
+                ("modelNamesAndIds", {}),
+                ("getMediaDirPath", {}),
+                ("getMediaFilesNames", dict(pattern=f"{self.PREFIX}_*")),
+            ]
+            results = self._query("multi", actions=self._get_multi_actions(actions))
+            deck_ids, model_ids, media_dir_path, media_names = [self._check_response(result) for result in results]
+            self.media_dir_path = Path(media_dir_path)
+            self._media_names.update(media_names)
+
+            deck_id = deck_ids.get(self.DECK_NAME)
+            if deck_id is None:
+                deck_id = self._query("createDeck", deck=self.DECK_NAME)
+
+            model_id = model_ids.get(self.MODEL_NAME)
+            if model_id is None:
+                tpl_dir = Path(__file__).resolve().parent / "data"
+                front = open(tpl_dir / "front.html").read()
+                back = open(tpl_dir / "back.html").read()
+                css = open(tpl_dir / "style.css").read()
+
+                model_id = self._query(
+                    "createModel",
+                    modelName=self.MODEL_NAME,
+                    inOrderFields=[
+                        "Word",
+                        "ContextPicture",
+                        "ContextSentence",
+                        "WordReading",
+                        "WordGlossary",
+                        "WordAudio",
+                        "ExtraInfo",
+                    ],
+                    css=css,
+                    cardTemplates=[dict(Front=front, Back=back)],
+                )
+            self._ready = True
 
     def add_note(self, note: AnkiNote) -> AnkiNote:
+        patched_note = self.add_notes([note])[0]
+        if patched_note.anki_id == -1:
+            raise Exception("note was rejected by Anki")
+        return patched_note
+
+    def add_notes(
+        self,
+        notes: list[AnkiNote],
+        media_data: dict[Path, bytes] | None = None,
+        media_filenames: dict[Path, str] | None = None,
+    ) -> list[AnkiNote]:
+        """
+        Add notes in a single request; notes rejected by Anki are returned
+        with an anki_id of -1. The content of the media files can be
+        provided in media_data to avoid reading them back, and their names
+        in Anki (see get_media_filename()) in media_filenames to avoid
+        hashing them.
+        """
+        self._setup()  # the media names are needed to craft the notes
+        media_data = media_data if media_data is not None else {}
+        media_filenames = media_filenames if media_filenames is not None else {}
+        params_list, patched_notes = [], []
+        for note in notes:
+            params, patched_note = self._get_note_params(note, media_data, media_filenames)
+            params_list.append(params)
+            patched_notes.append(patched_note)
+        anki_ids = self.query("addNotes", notes=params_list)
+        for params, patched_note, anki_id in zip(params_list, patched_notes, anki_ids):
+            patched_note.anki_id = anki_id if anki_id is not None else -1
+            if anki_id is not None:
+                self._media_names.update(media["filename"] for media in params.get("picture", []))
+                self._media_names.update(media["filename"] for media in params.get("audio", []))
+        return patched_notes
+
+    def _get_note_params(
+        self, note: AnkiNote, media_data: dict[Path, bytes], media_filenames: dict[Path, str]
+    ) -> tuple[dict, AnkiNote]:
         # Craft a ruby string for Anki furigana text on the back side
         reading = note.word
         if note.word_reading and note.word_reading != note.word:
@@ -85,42 +191,88 @@ class AnkiConnect:
             tags=[self.PREFIX],
         )
 
+        # Media already in Anki are directly referenced in the fields, with
+        # the same markup AnkiConnect would use
         if note.context_picture:
-            with open(note.context_picture, "rb") as f:
-                picture_filename, data_base64 = self._get_file(note.context_picture)
-            params["picture"] = [dict(filename=picture_filename, data=data_base64, fields=["ContextPicture"])]
+            picture_data = media_data.get(note.context_picture)
+            picture_filename = media_filenames.get(note.context_picture) or self.get_media_filename(
+                note.context_picture, picture_data
+            )
+            if picture_filename in self._media_names:
+                params["fields"]["ContextPicture"] = f'<img src="{picture_filename}">'
+            else:
+                data_base64 = self._get_media_data(note.context_picture, picture_data)
+                params["picture"] = [dict(filename=picture_filename, data=data_base64, fields=["ContextPicture"])]
+            picture_path = self.media_dir_path / picture_filename
+        else:
+            picture_path = None
 
         if note.word_audio:
-            with open(note.word_audio, "rb") as f:
-                audio_filename, data_base64 = self._get_file(note.word_audio)
-            params["audio"] = [dict(filename=audio_filename, data=data_base64, fields=["WordAudio"])]
+            audio_data = media_data.get(note.word_audio)
+            audio_filename = media_filenames.get(note.word_audio) or self.get_media_filename(
+                note.word_audio, audio_data
+            )
+            if audio_filename in self._media_names:
+                params["fields"]["WordAudio"] = f"[sound:{audio_filename}]"
+            else:
+                data_base64 = self._get_media_data(note.word_audio, audio_data)
+                params["audio"] = [dict(filename=audio_filename, data=data_base64, fields=["WordAudio"])]
+            audio_path = self.media_dir_path / audio_filename
+        else:
+            audio_path = None
 
         patched_note = AnkiNote(**asdict(note))
         patched_note.word_reading = reading
-        patched_note.anki_id = self.query("addNote", note=params)
-        return patched_note
+        patched_note.context_picture = picture_path  # same as what list_notes() would return
+        patched_note.word_audio = audio_path
+        return params, patched_note
 
-    def _get_file(self, filepath: Path) -> tuple[str, str]:
-        with open(filepath, "rb") as f:
-            content = f.read()
+    def _load_media_hashes(self) -> dict[str, tuple[int, int, str]]:
+        try:
+            media_hashes = json.loads(self._media_hashes_path.read_text())
+        except (FileNotFoundError, ValueError):
+            return {}
+        return {path: tuple(info) for path, info in media_hashes.items() if Path(path).exists()}
 
-            # Generate a unique filename based on the content
-            picture_hash = hashlib.sha256()
-            picture_hash.update(content)
-            picture_hash = picture_hash.hexdigest()
+    def get_media_filename(self, filepath: Path, data: bytes | None = None) -> str:
+        """
+        Generate a unique filename based on the content. The hashes of the
+        files are cached, so this is meant for files at a stable location.
+        """
+        if data is not None:
+            return f"{self.PREFIX}_{hashlib.sha256(data).hexdigest()}{filepath.suffix}"
 
-            # Anki might be a sandboxed app where access to the filesystem is
-            # restricted (typical usecase: a flatpak), so we use a base64 encode
-            # instead of a file path.
-            data_base64 = base64.b64encode(content).decode("utf-8")
+        stat = filepath.stat()
+        key = filepath.resolve().as_posix()
+        with self._media_hashes_lock:
+            info = self._media_hashes.get(key)
+        if info is not None and info[:2] == (stat.st_size, stat.st_mtime_ns):
+            content_hash = info[2]
+        else:
+            content_hash = hashlib.sha256(filepath.read_bytes()).hexdigest()
+            with self._media_hashes_lock:
+                self._media_hashes[key] = (stat.st_size, stat.st_mtime_ns, content_hash)
+                self._media_hashes_path.parent.mkdir(parents=True, exist_ok=True)
+                tmp_path = self._media_hashes_path.with_suffix(".tmp")
+                tmp_path.write_text(json.dumps(self._media_hashes))
+                os.replace(tmp_path, self._media_hashes_path)
+        return f"{self.PREFIX}_{content_hash}{filepath.suffix}"
 
-        filename = f"{self.PREFIX}_{picture_hash}{filepath.suffix}"
-
-        return filename, data_base64
+    @staticmethod
+    def _get_media_data(filepath: Path, data: bytes | None = None) -> str:
+        # Anki might be a sandboxed app where access to the filesystem is
+        # restricted (typical usecase: a flatpak), so we use a base64 encode
+        # instead of a file path.
+        if data is None:
+            data = filepath.read_bytes()
+        return base64.b64encode(data).decode("utf-8")
 
     def list_notes(self) -> list[AnkiNote]:
         notes = self.query("findNotes", query=f"deck:{self.DECK_NAME}")
-        notes_info = self.query("notesInfo", notes=notes)
+        return self.get_notes(notes)
+
+    def get_notes(self, anki_ids: list[int]) -> list[AnkiNote]:
+        notes_info = self.query("notesInfo", notes=anki_ids)
 
         notes = []
         for note_info in notes_info:
@@ -153,11 +305,7 @@ class AnkiConnect:
         self.query("deleteNotes", notes=[anki_id])
 
     @staticmethod
-    def query(action, **params):
-        # print(f"Anki: {action}", params)
-        request_data = dict(action=action, params=params, version=6)
-        request_json = json.dumps(request_data).encode("utf-8")
-        response = json.load(urlopen(Request("http://localhost:8765", request_json)))
+    def _check_response(response):
         if len(response) != 2:
             raise Exception("response has an unexpected number of fields")
         if "error" not in response:
@@ -165,10 +313,371 @@ class AnkiConnect:
         if "result" not in response:
             raise Exception("response is missing required result field")
         if response["error"] is not None:
-            raise Exception(response["error"])
+            raise AnkiError(response["error"])
         return response["result"]
 
+    def _post(self, request_json: bytes):
+        headers = {"Content-Type": "application/json"}
+        with self._conn_lock:
+            try:
+                try:
+                    self._conn.request("POST", "/", request_json, headers)
+                    response = self._conn.getresponse()
+                except (http.client.RemoteDisconnected, ConnectionResetError, BrokenPipeError):
+                    # The server closed the kept-alive connection, retry once on a new one
+                    self._conn.close()
+                    self._conn.request("POST", "/", request_json, headers)
+                    response = self._conn.getresponse()
+                return json.load(response)
+            except Exception:
+                # Reset the connection state so that the next request can be made
+                self._conn.close()
+                raise
+
+    def query(self, action, **params):
+        self._setup()
+        return self._query(action, **params)
+
+    def _query(self, action, **params):
+        # print(f"Anki: {action}", params)
+        request_data = dict(action=action, params=params, version=6)
+        request_json = json.dumps(request_data).encode("utf-8")
+        with trace.span("anki.post", action=action, size=len(request_json)):
+            return self._check_response(self._post(request_json))
+
+    def multi(self, *actions: tuple[str, dict]) -> list:
+        """Run several (action, params) in a single request and return their results"""
+        results = self.query("multi", actions=self._get_multi_actions(actions))
+        return [self._check_response(result) for result in results]
+
+    @staticmethod
+    def _get_multi_actions(actions: tuple[tuple[str, dict], ...] | list[tuple[str, dict]]) -> list[dict]:
+        # Without a version, AnkiConnect answers the actions with the bare
+        # results of version 4
+        return [dict(action=action, params=params, version=6) for action, params in actions]
+
+
+class AnkiMirror:
+    """
+    Local copy of the SnapStudySensei deck notes, stored in SQLite.
+
+    The mirror is synchronized incrementally: only the notes that are not
+    known yet or that were edited since the last synchronization are
+    fetched from Anki, and the ones that disappeared from the deck are
+    dropped.
+    """
+
+    COLUMNS = [field.name for field in fields(AnkiNote)]
+
+    def __init__(self, path: Path | None = None):
+        if path is None:
+            path = xdg_data_home() / "SnapStudySensei" / "anki_mirror.sqlite"
+            path.parent.mkdir(parents=True, exist_ok=True)
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db_lock = threading.Lock()
+        with self._db_lock, self._db:
+            self._db.execute(
+                "CREATE TABLE IF NOT EXISTS notes ("
+                "word TEXT, context_picture TEXT, context_sentence TEXT, word_reading TEXT, "
+                "word_glossary TEXT, word_audio TEXT, extra_info TEXT, anki_id INTEGER PRIMARY KEY)"
+            )
+            self._db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value)")
+
+    def list_notes(self) -> list[AnkiNote]:
+        with self._db_lock:
+            rows = self._db.execute(f"SELECT {', '.join(self.COLUMNS)} FROM notes ORDER BY anki_id").fetchall()
+        return [AnkiNote.from_dict(dict(zip(self.COLUMNS, row))) for row in rows]
+
+    def put_notes(self, notes: list[AnkiNote]):
+        rows = [note.to_dict() for note in notes]
+        placeholders = ", ".join(f":{column}" for column in self.COLUMNS)
+        with self._db_lock, self._db:
+            self._db.executemany(f"INSERT OR REPLACE INTO notes VALUES ({placeholders})", rows)
+
+    def remove_notes(self, anki_ids: list[int]):
+        with self._db_lock, self._db:
+            self._db.executemany("DELETE FROM notes WHERE anki_id = ?", [(anki_id,) for anki_id in anki_ids])
+
+    def _get_meta(self, key: str, default=None):
+        with self._db_lock:
+            row = self._db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row is not None else default
+
+    def _set_meta(self, key: str, value):
+        with self._db_lock, self._db:
+            self._db.execute("INSERT OR REPLACE INTO meta VALUES (?, ?)", (key, value))
+
+    def sync(self, anki: AnkiConnect) -> tuple[list[AnkiNote], list[int]]:
+        """Update the mirror from Anki and return the added or changed notes, and the removed IDs"""
+        sync_time = time.time()
+        last_sync = self._get_meta("last_sync")
+
+        # Anki can only search for notes edited in the last N days
+        deck_query = f"deck:{anki.DECK_NAME}"
+        if last_sync is None:
+            edited_query = deck_query
+        else:
+            days = int((sync_time - last_sync) // 86400) + 1
+            edited_query = f"{deck_query} edited:{days}"
+
+        # Read before the request, so that the notes put in the meantime (as
+        # they are added by the queue) aren't taken as removed from Anki
+        with self._db_lock:
+            known_ids = {row[0] for row in self._db.execute("SELECT anki_id FROM notes")}
+        anki_ids, edited_ids = anki.multi(
+            ("findNotes", dict(query=deck_query)),
+            ("findNotes", dict(query=edited_query)),
+        )
+        removed_ids = list(known_ids.difference(anki_ids))
+        fetched_ids = sorted(set(anki_ids).difference(known_ids).union(edited_ids))
+
+        notes = anki.get_notes(fetched_ids) if fetched_ids else []
+        self.put_notes(notes)
+        self.remove_notes(removed_ids)
+        self._set_meta("last_sync", sync_time)
+        return notes, removed_ids
+
+
+class AnkiQueue:
+    """
+    Write-behind queue of notes to add to Anki.
+
+    Submitted notes are persisted on disk along with their media and added
+    from a background thread, in batches when several are pending. If Anki
+    can not be reached, the submission is retried later, including after a
+    restart of the application.
+    """
+
+    # Pending IDs are told apart from Anki IDs with it
+    PENDING_PREFIX = "pending-"
+
+    RETRY_DELAY_MIN = 1
+    RETRY_DELAY_MAX = 60
+
+    def __init__(self, anki: AnkiConnect, on_done: Callable[[str, AnkiNote | None], None], path: Path | None = None):
+        """on_done is called from the queue thread with the pending ID and the added note (None if rejected)"""
+        self._anki = anki
+        self._on_done = on_done
+        self._dir = path if path is not None else xdg_data_home() / "SnapStudySensei" / "pending"
+        self._dir.mkdir(parents=True, exist_ok=True)
+
+        # Pending ID → (note, function to encode the picture, if not done yet)
+        self._pending: dict[str, tuple[AnkiNote, Callable[[], tuple[bytes, str]] | None]] = {}
+        self._media_data: dict[Path, bytes] = {}  # encoded pictures, to avoid reading them back
+        self._media_filenames: dict[Path, str] = {}  # names in Anki of the copied audio files
+        self._in_flight: set[str] = set()  # pending IDs of the batch being submitted
+        self._cond = threading.Condition()
+        self._closed = False
+        for note_path in sorted(self._dir.glob("*.json"), key=lambda p: p.stat().st_mtime):
+            data = json.loads(note_path.read_text())
+            audio_filename = data.pop("audio_filename", None)
+            note = AnkiNote.from_dict(data)
+            if note.context_picture and not note.context_picture.exists():
+                note.context_picture = None  # the application stopped before it was written
+            if note.word_audio and not note.word_audio.exists():
+                note.word_audio = None
+            pending_id = note_path.stem
+            if not pending_id.startswith(self.PENDING_PREFIX):
+                pending_id = self._add_prefix(note_path, note)
+            if note.word_audio and audio_filename:
+                self._media_filenames[note.word_audio] = audio_filename
+            self._pending[pending_id] = (note, None)
+
+        self._thread = threading.Thread(target=self._run, name="anki-queue", daemon=True)
+        self._thread.start()
+
+    def _add_prefix(self, note_path: Path, note: AnkiNote) -> str:
+        """Rename the files of a note queued before the pending IDs had a prefix"""
+        pending_id = self.PENDING_PREFIX + note_path.stem
+        for field in ("context_picture", "word_audio"):
+            path = getattr(note, field)
+            if path is not None:
+                new_path = self._dir / (self.PENDING_PREFIX + path.name)
+                path.rename(new_path)
+                setattr(note, field, new_path)
+        (self._dir / f"{pending_id}.json").write_text(json.dumps(note.to_dict()))
+        note_path.unlink()
+        return pending_id
+
+    def get_pending(self) -> dict[str, AnkiNote]:
+        with self._cond:
+            return {pending_id: note for pending_id, (note, _) in self._pending.items()}
+
+    def submit(self, note: AnkiNote, encode_picture: Callable[[], tuple[bytes, str]] | None = None) -> str:
+        """
+        Queue a note and return its pending ID. The picture, if any, is
+        encoded by encode_picture from the queue thread, which returns the
+        encoded data and the file suffix.
+        """
+        pending_id = self.PENDING_PREFIX + uuid.uuid4().hex
+        note = AnkiNote(**asdict(note))
+        note.context_picture = None
+        if note.word_audio:
+            # The audio file may be a temporary file overwritten later; it is
+            # hashed from its original location, where the hash is cached
+            audio_path = self._dir / f"{pending_id}{note.word_audio.suffix}"
+            try:
+                audio_filename = self._anki.get_media_filename(note.word_audio)
+                shutil.copyfile(note.word_audio, audio_path)
+            except FileNotFoundError:
+                # Evicted from the audio cache since it was fetched
+                print(f"audio file {note.word_audio} is gone, adding the note without it", file=sys.stderr)
+                note.word_audio = None
+            else:
+                note.word_audio = audio_path
+                self._media_filenames[audio_path] = audio_filename
+        self._write_note(pending_id, note)
+        with self._cond:
+            self._pending[pending_id] = (note, encode_picture)
+            self._cond.notify()
+        return pending_id
+
+    def cancel(self, pending_id: str) -> bool:
+        """Remove a note that was not submitted yet; return False if it is (being) submitted"""
+        with self._cond:
+            if pending_id in self._in_flight or self._pending.pop(pending_id, None) is None:
+                return False
+        self._remove_files(pending_id)
+        return True
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+
+    def _write_note(self, pending_id: str, note: AnkiNote):
+        data = note.to_dict()
+        if note.word_audio in self._media_filenames:
+            data["audio_filename"] = self._media_filenames[note.word_audio]
+        (self._dir / f"{pending_id}.json").write_text(json.dumps(data))
+
+    def _remove_files(self, pending_id: str):
+        for path in self._dir.glob(f"{pending_id}.*"):
+            self._media_data.pop(path, None)
+            self._media_filenames.pop(path, None)
+            path.unlink(missing_ok=True)
+
+    def _encode_picture(self, pending_id: str, note: AnkiNote, encode_picture: Callable[[], tuple[bytes, str]]):
+        data, suffix = encode_picture()
+        picture_path = self._dir / f"{pending_id}{suffix}"
+        picture_path.write_bytes(data)  # only read back if the application is restarted
+        with self._cond:
+            self._media_data[picture_path] = data
+            note.context_picture = picture_path
+            self._write_note(pending_id, note)
+            self._pending[pending_id] = (note, None)
+
+    def _run(self):
+        delay = self.RETRY_DELAY_MIN
+        while True:
+            with self._cond:
+                while not self._pending and not self._closed:
+                    self._cond.wait()
+                if self._closed:
+                    return
+                batch = list(self._pending.items())
+                self._in_flight.update(pending_id for pending_id, _ in batch)
+
+            for pending_id, (note, encode_picture) in batch:
+                if encode_picture is not None:
+                    try:
+                        self._encode_picture(pending_id, note, encode_picture)
+                    except Exception as e:
+                        print(f"unable to encode the picture, adding the note without it: {e}", file=sys.stderr)
+                        with self._cond:
+                            self._pending[pending_id] = (note, None)
+
+            # Notes are only dropped when Anki returned an error for them;
+            # on any other failure (Anki unreachable, not set up...), the
+            # ones left are submitted again later
+            try:
+                self._anki._setup()
+                self._add_batch(batch)
+            except Exception as e:
+                print(f"unable to add the notes to Anki, retrying in {delay}s: {e}", file=sys.stderr)
+                with self._cond:
+                    self._in_flight.clear()  # can be cancelled until the next attempt
+                    self._cond.wait_for(lambda: self._closed, timeout=delay)
+                delay = min(delay * 2, self.RETRY_DELAY_MAX)
+                continue
+            delay = self.RETRY_DELAY_MIN
+
+    def _add_batch(self, batch: list[tuple[str, tuple[AnkiNote, Callable | None]]]):
+        try:
+            notes = [note for _, (note, _) in batch]
+            added_notes = self._anki.add_notes(notes, self._media_data, self._media_filenames)
+        except AnkiError as e:
+            # Anki refused the batch as a whole; submit the notes one by one
+            # to identify the faulty ones
+            print(f"notes rejected by Anki ({e}), adding them separately", file=sys.stderr)
+            for pending_id, (note, _) in batch:
+                try:
+                    added_note = self._anki.add_notes([note], self._media_data, self._media_filenames)[0]
+                except AnkiError:
+                    added_note = None
+                self._done(pending_id, added_note)
+            return
+        for (pending_id, _), added_note in zip(batch, added_notes):
+            self._done(pending_id, added_note)
+
+    def _done(self, pending_id: str, added_note: AnkiNote | None):
+        if added_note is not None and added_note.anki_id == -1:
+            added_note = None
+        with self._cond:
+            self._pending.pop(pending_id, None)
+            self._in_flight.discard(pending_id)
+        self._remove_files(pending_id)
+        self._on_done(pending_id, added_note)
+
 
 if __name__ == "__main__":
-    a = AnkiConnect()
-    print(a.list_notes())
+    if sys.argv[1:] != ["--check"]:
+        a = AnkiConnect()
+        print(a.list_notes())
+        sys.exit()
+
+    # Check the client against a local stand-in server:
+    # python -m snapstudysensei.anki --check
+    import socket
+
+    from snapstudysensei.fake_servers import FakeAnkiConnect
+
+    server = FakeAnkiConnect()
+    a = AnkiConnect("127.0.0.1", server.port)
+    notes = [AnkiNote(f"単語{i}", None, "文", "たんご", "word") for i in range(3)]
+    added_notes = a.add_notes(notes)
+    assert all(note.anki_id != -1 for note in added_notes)
+    sock = a._conn.sock
+    assert [note.word for note in a.list_notes()] == [note.word for note in notes]
+    assert a._conn.sock is sock, "the connection was not kept alive"
+    deck_ids, model_ids = a.multi(("deckNamesAndIds", {}), ("modelNamesAndIds", {}))
+    assert deck_ids == model_ids == {}
+    rejected_note = a.add_notes([AnkiNote("", None, "文", "", "")])[0]
+    assert rejected_note.anki_id == -1
+    a.remove_note(added_notes[0].anki_id)
+    assert len(a.list_notes()) == len(notes) - 1
+    server.close()
+
+    # Anki not running: the client can be created, its requests fail
+    with socket.socket() as s:
+        s.bind(("127.0.0.1", 0))
+        port = s.getsockname()[1]
+    a = AnkiConnect("127.0.0.1", port)
+    try:
+        a.list_notes()
+    except ConnectionRefusedError:
+        pass
+    else:
+        raise AssertionError("the request did not fail")
+
+    # A server which accepts the connection but never answers
+    with socket.create_server(("127.0.0.1", 0)) as listener:
+        a._conn = http.client.HTTPConnection("127.0.0.1", listener.getsockname()[1], timeout=0.5)
+        try:
+            a.query("version")
+        except TimeoutError:
+            pass
+        else:
+            raise AssertionError("the request did not time out")
+    print("ok")
@@ -0,0 +1,335 @@
+"""
+Headless mining of screenshots: OCR, dictionary lookup and Anki notes.
+
+    sss batch [options] SPEC...
+
+Each SPEC is an image file, optionally followed by one or more regions
+(in pixels) to read, e.g. "shot.png@120,40,300,80@10,400,200,60"; without
+region, the whole image is read. Directories are expanded to the images
+they contain. Progress is checkpointed, so running the same command again
+resumes an interrupted run.
+"""
+
+import argparse
+import dataclasses
+import hashlib
+import http.client
+import json
+import os
+import re
+import sys
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from multiprocessing import get_context
+from pathlib import Path
+
+from PySide6.QtCore import QRect
+from PySide6.QtGui import QImage
+from xdg_base_dirs import xdg_data_home
+
+from snapstudysensei.anki import AnkiConnect, AnkiNote
+from snapstudysensei.picture import PictureEncoder
+from snapstudysensei.qimage_view import to_pil
+
+IMAGE_SUFFIXES = {".png", ".jpg", ".jpeg", ".webp", ".bmp"}
+
+# Every OCR process loads its own model along with the torch runtime
+WORKER_MEMORY = 1024**3
+MAX_DEFAULT_JOBS = 8
+_REGION_RE = re.compile(r"^(\d+),(\d+),(\d+),(\d+)$")
+
+# Per worker process state, see _init_worker()
+_ocr = None
+_picture_encoder = None
+
+
+def _parse_spec(spec: str) -> list[tuple[Path, tuple[int, int, int, int] | None]]:
+    """Split a SPEC into (image, region) work units"""
+    regions = []
+    path = spec
+    while "@" in path:
+        head, tail = path.rsplit("@", 1)
+        match = _REGION_RE.match(tail)
+        if match is None:
+            break  # "@" is part of the file name
+        regions.insert(0, tuple(int(value) for value in match.groups()))
+        path = head
+
+    path = Path(path)
+    if path.is_dir():
+        if regions:
+            raise ValueError(f"{spec}: regions can not be applied to a directory")
+        return [(p, None) for p in sorted(path.iterdir()) if p.suffix.lower() in IMAGE_SUFFIXES]
+    if not path.exists():
+        raise ValueError(f"{spec}: no such file")
+    return [(path, region) for region in regions] if regions else [(path, None)]
+
+
+def _get_unit_key(path: Path, region: tuple[int, int, int, int] | None) -> str:
+    key = path.resolve().as_posix()
+    return key if region is None else key + "@" + ",".join(map(str, region))
+
+
+def _init_worker(backend: str, num_threads: int, picture_encoder: PictureEncoder | None):
+    global _ocr, _picture_encoder
+    from snapstudysensei.ocr import OCRWrapper
+
+    _ocr = OCRWrapper(backend=backend, num_threads=num_threads)
+    _picture_encoder = picture_encoder
+
+
+def _process_unit(
+    path: Path, region: tuple[int, int, int, int] | None, crop_picture: bool
+) -> tuple[str, bytes | None, str]:
+    """Read the text of a unit (run in the worker processes), along with its encoded picture"""
+    image = QImage(str(path))
+    if image.isNull():
+        raise Exception(f"unable to read {path}")
+    rect = QRect(*region).intersected(image.rect()) if region is not None else image.rect()
+    text = _ocr(to_pil(image.copy(rect))).strip()
+    if not text or _picture_encoder is None:
+        return text, None, ""
+    data, suffix = _picture_encoder(image, rect if crop_picture else None)
+    return text, data, suffix
+
+
+class _Checkpoint:
+    """
+    Append-only log of the units which are done (their notes are in Anki),
+    with the words they produced so that they are not mined twice.
+    """
+
+    def __init__(self, path: Path):
+        self._path = path
+        self.done: set[str] = set()
+        self.words: set[str] = set()
+        if path.exists():
+            for line in path.read_text(encoding="utf-8").splitlines():
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # truncated by an interruption
+                self.done.add(record["unit"])
+                self.words.update(record["words"])
+        path.parent.mkdir(parents=True, exist_ok=True)
+        self._file = open(path, "a", encoding="utf-8")
+
+    def add(self, unit_key: str, words: list[str]):
+        self.done.add(unit_key)
+        self.words.update(words)
+        self._file.write(json.dumps(dict(unit=unit_key, words=words), ensure_ascii=False) + "\n")
+
+    def flush(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        self._file.close()
+
+
+class BatchMiner:
+    """Turn OCR results into notes, added to Anki in batches"""
+
+    def __init__(self, dic, anki: AnkiConnect, checkpoint: _Checkpoint, min_length: int, batch_size: int):
+        self._dic = dic
+        self._anki = anki
+        self._checkpoint = checkpoint
+        self._min_length = min_length
+        self._batch_size = batch_size
+        self._known_words = set(checkpoint.words)
+
+        # Notes waiting to be sent, and the units they come from
+        self._notes: list[AnkiNote] = []
+        self._media_data: dict[Path, bytes] = {}
+        self._units: list[tuple[str, list[str]]] = []
+
+        self.added = 0
+        self.rejected = 0
+
+    def skip_existing(self):
+        """Do not mine the words which already are in the deck"""
+        self._known_words.update(note.word for note in self._anki.list_notes())
+
+    def _get_words(self, sentence: str) -> list[str]:
+        """New words of the sentence, long enough to be mined"""
+        words = []
+        for start, end, word in self._dic.scan_longest(sentence):
+            if end - start >= self._min_length and word not in self._known_words:
+                self._known_words.add(word)
+                words.append(word)
+        return words
+
+    def add(self, unit_key: str, text: str, picture: bytes | None, suffix: str):
+        words = self._get_words(text) if text else []
+        picture_path = None
+        if words and picture is not None:
+            # Only used to name the media; the data is passed along
+            picture_path = Path(hashlib.sha256(unit_key.encode()).hexdigest()).with_suffix(suffix)
+            self._media_data[picture_path] = picture
+
+        for word in words:
+            entry = next(self._dic.lookup(word), None)
+            if entry is None:
+                continue
+            self._notes.append(
+                AnkiNote(
+                    word=word,
+                    context_picture=picture_path,
+                    context_sentence=text,
+                    word_reading=entry["reading"] if entry["reading"] != word else "",
+                    word_glossary=entry["senses"],
+                )
+            )
+        self._units.append((unit_key, words))
+        if len(self._notes) >= self._batch_size or len(self._units) >= self._batch_size:
+            self.flush()
+
+    def flush(self):
+        if self._notes:
+            added_notes = self._anki.add_notes(self._notes, self._media_data)
+            rejected = sum(note.anki_id == -1 for note in added_notes)
+            self.rejected += rejected
+            self.added += len(added_notes) - rejected
+        for unit_key, words in self._units:
+            self._checkpoint.add(unit_key, words)
+        self._checkpoint.flush()
+        self._notes.clear()
+        self._media_data.clear()
+        self._units.clear()
+
+
+def _get_default_jobs() -> int:
+    """One OCR process per core, as long as they fit in the available memory"""
+    jobs = min(os.cpu_count() or 1, MAX_DEFAULT_JOBS)
+    try:
+        with open("/proc/meminfo") as f:
+            meminfo = dict(line.split(":", 1) for line in f)
+        available = int(meminfo["MemAvailable"].split()[0]) * 1024
+    except (OSError, KeyError, ValueError):
+        return jobs
+    return max(1, min(jobs, available // WORKER_MEMORY))
+
+
+def _get_checkpoint_path(unit_keys: list[str]) -> Path:
+    """Default checkpoint, identified by the set of units of the run"""
+    digest = hashlib.sha256("\n".join(sorted(unit_keys)).encode()).hexdigest()[:16]
+    return xdg_data_home() / "SnapStudySensei" / "batch" / f"{digest}.jsonl"
+
+
+def main(argv: list[str] | None = None):
+    parser = argparse.ArgumentParser(
+        prog="sss batch", description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter
+    )
+    parser.add_argument("specs", nargs="+", metavar="SPEC", help="image[@x,y,w,h...] or directory")
+    parser.add_argument(
+        "-j", "--jobs", type=int, default=_get_default_jobs(), help="number of OCR processes (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--ocr-backend", default="int8", help="OCR backend (default: int8, CPU only, which scales with the jobs)"
+    )
+    parser.add_argument(
+        "--picture", choices=("full", "crop", "none"), default="full", help="picture attached to the notes"
+    )
+    parser.add_argument(
+        "--picture-format", choices=tuple(PictureEncoder.SUFFIXES), help="default: webp, or SSS_PICTURE_FORMAT"
+    )
+    parser.add_argument(
+        "--picture-quality", type=int, metavar="0-100", help="ignored for PNG (default: 85, or SSS_PICTURE_QUALITY)"
+    )
+    parser.add_argument(
+        "--picture-max-size",
+        type=int,
+        metavar="PIXELS",
+        help="0 to keep the original size (default: 1280, or SSS_PICTURE_MAX_SIZE)",
+    )
+    parser.add_argument("--min-length", type=int, default=2, help="minimum length of the mined words")
+    parser.add_argument("--batch-size", type=int, default=50, help="number of notes per addNotes request")
+    parser.add_argument("--include-existing", action="store_true", help="also mine the words already in the deck")
+    parser.add_argument("--checkpoint", type=Path, help="progress file (default: derived from the SPECs)")
+    args = parser.parse_args(argv)
+
+    picture_encoder = None
+    if args.picture != "none":
+        overrides = dict(format=args.picture_format, quality=args.picture_quality)
+        overrides = {name: value for name, value in overrides.items() if value is not None}
+        if args.picture_max_size is not None:
+            overrides["max_size"] = args.picture_max_size or None
+        try:
+            picture_encoder = dataclasses.replace(PictureEncoder.from_env(), **overrides)
+        except ValueError as e:
+            parser.error(str(e))
+
+    try:
+        units = [unit for spec in args.specs for unit in _parse_spec(spec)]
+    except ValueError as e:
+        parser.error(str(e))
+    unit_keys = [_get_unit_key(path, region) for path, region in units]
+
+    checkpoint_path = args.checkpoint or _get_checkpoint_path(unit_keys)
+    checkpoint = _Checkpoint(checkpoint_path)
+    todo = [(unit, key) for unit, key in zip(units, unit_keys) if key not in checkpoint.done]
+    print(f":: {len(units)} regions to read, {len(units) - len(todo)} already done ({checkpoint_path})")
+    if not todo:
+        return
+
+    # The workers are started first so that their (slow) initialization
+    # overlaps with the loading of the dictionary; each one gets its share
+    # of the cores for the inference
+    jobs = max(1, min(args.jobs, len(todo)))
+    num_threads = max(1, (os.cpu_count() or 1) // jobs)
+    executor = ProcessPoolExecutor(
+        max_workers=jobs,
+        mp_context=get_context("spawn"),
+        initializer=_init_worker,
+        initargs=(args.ocr_backend, num_threads, picture_encoder),
+    )
+    crop_picture = args.picture == "crop"
+    pending = {executor.submit(_process_unit, path, region, crop_picture): key for (path, region), key in todo}
+
+    from snapstudysensei.dic import JDictionary
+
+    print(":: initializing dictionary")
+    dic = JDictionary()
+
+    done = failed = 0
+    try:
+        anki = AnkiConnect()
+        miner = BatchMiner(dic, anki, checkpoint, args.min_length, args.batch_size)
+        if not args.include_existing:
+            miner.skip_existing()
+
+        while pending:
+            completed, _ = wait(pending, return_when=FIRST_COMPLETED)
+            for future in completed:
+                unit_key = pending.pop(future)
+                try:
+                    text, picture, suffix = future.result()
+                except BrokenProcessPool:
+                    raise
+                except Exception as e:
+                    print(f"{unit_key}: {e}", file=sys.stderr)
+                    failed += 1
+                    continue
+                miner.add(unit_key, text, picture, suffix)
+                done += 1
+            print(f"{done}/{len(todo)} read, {miner.added} notes added", end="\r", flush=True)
+        miner.flush()
+    except (OSError, http.client.HTTPException) as e:
+        sys.exit(f"\nunable to reach Anki ({e}), run the same command again to resume")
+    except BrokenProcessPool:
+        sys.exit("\nthe OCR processes could not be started")
+    except KeyboardInterrupt:
+        sys.exit("\ninterrupted, run the same command again to resume")
+    except Exception as e:
+        # Typically an error returned by Anki-Connect
+        sys.exit(f"\nunable to add the notes to Anki ({e}), run the same command again to resume")
+    finally:
+        executor.shutdown(wait=False, cancel_futures=True)
+        checkpoint.close()
+
+    print(f"\n:: {done} regions read ({failed} failed), {miner.added} notes added ({miner.rejected} rejected)")
+    sys.exit(failed != 0)
+
+
+if __name__ == "__main__":
+    main()
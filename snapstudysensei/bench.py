@@ -0,0 +1,328 @@
+"""
+Benchmarks of the performance sensitive parts of SnapStudySensei.
+
+Run the suite and save the results:
+    python -m snapstudysensei.bench run -o results.json
+
+Compare two runs (exits with an error if a metric regressed beyond the
+threshold):
+    python -m snapstudysensei.bench compare before.json after.json
+
+The dictionary benchmarks need the JMdict database to be already
+downloaded, and the OCR ones the ML stack; a benchmark whose requirements
+are not met is skipped.
+"""
+
+import argparse
+import itertools
+import json
+import os
+import platform
+import resource
+import statistics
+import subprocess
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+from itertools import islice
+from multiprocessing import get_context
+from pathlib import Path
+
+from xdg_base_dirs import xdg_data_home
+
+FORMAT_VERSION = 1
+
+# Fixed query set: common words in various forms (kanji, kana, inflected,
+# partial), and sentences for the candidates scan
+LOOKUP_WORDS = (
+    "日本",
+    "食べる",
+    "猫",
+    "行く",
+    "見る",
+    "学生",
+    "大きい",
+    "ありがとう",
+    "東京",
+    "勉強",
+    "たべる",
+    "こと",
+    "先生",
+    "電車",
+    "気",
+    "日",
+)
+SCAN_SENTENCES = (
+    "日本の猫は魚を食べるのが好きです",
+    "明日は東京へ行く予定だ",
+    "先生に勉強を教えてもらった",
+    "大きい電車が駅に着いた",
+)
+OCR_SENTENCES = (
+    "日本語",
+    "今日はいい天気ですね",
+    "何をしているの？",
+    "ありがとうございました！",
+)
+
+
+class _Results:
+    """Collect the metrics and print them as they come"""
+
+    def __init__(self):
+        self.metrics: dict[str, dict] = {}
+        self.skipped: dict[str, str] = {}
+
+    def add(self, name: str, value: float, unit: str, higher_is_better: bool = False):
+        self.metrics[name] = dict(value=value, unit=unit, higher_is_better=higher_is_better)
+        print(f"{name}: {value:.4g} {unit}")
+
+    def add_latencies(self, name: str, durations: list[float]):
+        durations = sorted(durations)
+        self.add(f"{name}.p50", statistics.median(durations) * 1e3, "ms")
+        self.add(f"{name}.p95", durations[min(len(durations) - 1, round(len(durations) * 0.95))] * 1e3, "ms")
+
+    def skip(self, name: str, reason: str):
+        self.skipped[name] = reason
+        print(f"{name}: skipped ({reason})", file=sys.stderr)
+
+
+def _time(func, *args) -> float:
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+
+def _get_dic_path() -> Path:
+    from snapstudysensei.dic import JDictionary
+
+    return xdg_data_home() / "SnapStudySensei" / (JDictionary.DB_NAME + ".xml")
+
+
+def _load_dic() -> tuple[float, int]:
+    """Load the dictionary in a fresh process, return the duration and the peak RSS (bytes)"""
+    from snapstudysensei.dic import JDictionary
+
+    start = time.perf_counter()
+    JDictionary()
+    duration = time.perf_counter() - start
+    return duration, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def bench_dic(results: _Results, repeat: int):
+    if not _get_dic_path().exists():
+        results.skip("dic", f"{_get_dic_path()} not found")
+        return
+
+    # Each load happens in its own process so that the RSS is not polluted by
+    # the previous runs; the first one (re)compiles the database if needed
+    loads = []
+    for _ in range(repeat + 1):
+        with ProcessPoolExecutor(max_workers=1, mp_context=get_context("spawn")) as executor:
+            loads.append(executor.submit(_load_dic).result())
+    loads = loads[1:]
+    results.add("dic.load", statistics.median(duration for duration, _ in loads) * 1e3, "ms")
+    results.add("dic.load_rss", max(rss for _, rss in loads) / (1024 * 1024), "MiB")
+
+    from snapstudysensei.dic import JDictionary
+
+    dic = JDictionary()
+    cold, warm = [], []
+    for _ in range(repeat):
+        # Lookups are measured without (cold) and with (warm) the rendered
+        # entries in cache
+        dic._render_entry.cache_clear()
+        for word in LOOKUP_WORDS:
+            cold.append(_time(lambda: list(islice(dic.lookup(word), dic.PAGE_SIZE))))
+        for word in LOOKUP_WORDS:
+            warm.append(_time(lambda: list(islice(dic.lookup(word), dic.PAGE_SIZE))))
+    results.add_latencies("dic.lookup_cold", cold)
+    results.add_latencies("dic.lookup_warm", warm)
+    scans = [_time(dic.scan, sentence) for _ in range(repeat) for sentence in SCAN_SENTENCES]
+    results.add_latencies("dic.scan", scans)
+
+
+def bench_ocr(results: _Results, repeat: int, backend: str, image_paths: list[Path]):
+    try:
+        from snapstudysensei.ocr import OCRWrapper, render_reference_set
+    except ImportError as e:
+        results.skip("ocr", str(e))
+        return
+    from PIL import Image
+
+    if image_paths:
+        crops = [Image.open(path).convert("RGB") for path in image_paths]
+    else:
+        crops = [crop for _, crop in render_reference_set(OCR_SENTENCES, sizes=(32,))]
+
+    start = time.perf_counter()
+    ocr = OCRWrapper(backend=backend, cache_size=0, persistent_cache=False)
+    results.add("ocr.load", (time.perf_counter() - start) * 1e3, "ms")
+    results.add_latencies("ocr.crop", [_time(ocr, crop) for _ in range(repeat) for crop in crops])
+
+
+class _SyntheticCapture:
+    """Stand-in for X11Capture, alternating between two frames when animated"""
+
+    def __init__(self, width: int, height: int, animated: bool):
+        from PySide6.QtGui import QImage, Qt
+
+        self._frames = [QImage(width, height, QImage.Format_RGB32) for _ in range(2)]
+        self._frames[0].fill(Qt.darkCyan)
+        self._frames[1].fill(Qt.darkMagenta)
+        self._index = itertools.cycle((0, 1) if animated else (0,))
+
+    def grab(self, wid: int):
+        return self._frames[next(self._index)]
+
+
+def bench_capture(results: _Results, repeat: int):
+    try:
+        from PySide6.QtMultimedia import QVideoSink
+
+        from snapstudysensei.window_capture import WindowCaptureProducer
+    except ImportError as e:
+        results.skip("capture", str(e))
+        return
+
+    number = 50 * repeat
+    for name, animated in (("changed", True), ("static", False)):
+        producer = WindowCaptureProducer()
+        producer.active = False  # refreshes are triggered manually
+        producer._capture = _SyntheticCapture(1920, 1080, animated)
+        producer.videoSink = QVideoSink()
+        producer.wid = 1
+        producer.refresh()  # initial frame
+        durations = [_time(producer.refresh) for _ in range(number)]
+        results.add_latencies(f"capture.refresh_{name}", durations)
+
+
+def bench_anki(results: _Results, repeat: int):
+    from snapstudysensei.anki import AnkiConnect, AnkiNote
+    from snapstudysensei.fake_servers import FakeAnkiConnect
+
+    server = FakeAnkiConnect()
+    try:
+        anki = AnkiConnect("127.0.0.1", server.port)
+        number = 100 * repeat
+        notes = [
+            AnkiNote(
+                word=f"単語{i}",
+                context_picture=None,
+                context_sentence="これは例文です",
+                word_reading="たんご",
+                word_glossary="word",
+            )
+            for i in range(number)
+        ]
+        duration = _time(lambda: [anki.add_note(note) for note in notes])
+        results.add("anki.add_note", number / duration, "notes/s", higher_is_better=True)
+        durations = [_time(anki.list_notes) for _ in range(repeat)]
+        results.add("anki.list_notes", number / statistics.median(durations), "notes/s", higher_is_better=True)
+    finally:
+        server.close()
+
+
+BENCHMARKS = ("dic", "ocr", "capture", "anki")
+
+
+def _get_meta() -> dict:
+    try:
+        commit = subprocess.run(
+            ["git", "rev-parse", "HEAD"], cwd=Path(__file__).parent, capture_output=True, text=True, check=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        commit = None
+    return dict(
+        time=time.strftime("%Y-%m-%dT%H:%M:%S%z"),
+        commit=commit,
+        python=platform.python_version(),
+        machine=platform.machine(),
+        processor=platform.processor(),
+        cpu_count=os.cpu_count(),
+    )
+
+
+def run(args):
+    # Benchmarks don't need a display
+    os.environ.setdefault("QT_QPA_PLATFORM", "offscreen")
+    from PySide6.QtGui import QGuiApplication
+
+    app = QGuiApplication(sys.argv[:1])  # noqa: F841 (needed for the fonts and the video sink)
+
+    results = _Results()
+    selected = args.only.split(",") if args.only else BENCHMARKS
+    for name in selected:
+        if name == "dic":
+            bench_dic(results, args.repeat)
+        elif name == "ocr":
+            bench_ocr(results, args.repeat, args.ocr_backend, args.ocr_images)
+        elif name == "capture":
+            bench_capture(results, args.repeat)
+        elif name == "anki":
+            bench_anki(results, args.repeat)
+        else:
+            sys.exit(f"unknown benchmark {name}")
+
+    output = dict(version=FORMAT_VERSION, meta=_get_meta(), metrics=results.metrics, skipped=results.skipped)
+    if args.output:
+        args.output.write_text(json.dumps(output, indent=2, ensure_ascii=False))
+
+
+def compare(args):
+    runs = []
+    for path in (args.before, args.after):
+        data = json.loads(path.read_text())
+        if data.get("version") != FORMAT_VERSION:
+            sys.exit(f"{path}: unsupported format version {data.get('version')}")
+        runs.append(data["metrics"])
+    before, after = runs
+
+    regressions = 0
+    for name in sorted(before.keys() | after.keys()):
+        if name not in before or name not in after:
+            where = "before" if name in before else "after"
+            print(f"{name:32} only in {where} run")
+            continue
+        old, new = before[name]["value"], after[name]["value"]
+        unit = after[name]["unit"]
+        change = (new - old) / old * 100 if old else 0.0
+        worse = -change if after[name]["higher_is_better"] else change
+        status = ""
+        if worse > args.threshold:
+            status = "REGRESSION"
+            regressions += 1
+        elif worse < -args.threshold:
+            status = "improvement"
+        print(f"{name:32} {old:10.4g} -> {new:10.4g} {unit:8} {change:+7.1f}% {status}")
+    sys.exit(regressions != 0)
+
+
+def main():
+    parser = argparse.ArgumentParser(prog="python -m snapstudysensei.bench")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="run the benchmarks")
+    run_parser.add_argument("-o", "--output", type=Path, help="JSON file to write the results to")
+    run_parser.add_argument("--only", help=f"comma separated list among {', '.join(BENCHMARKS)}")
+    run_parser.add_argument("--repeat", type=int, default=5, help="number of repetitions")
+    run_parser.add_argument("--ocr-backend", default="default", help="OCR backend to benchmark")
+    run_parser.add_argument(
+        "--ocr-images", type=Path, nargs="*", default=[], help="crops to use instead of the synthetic ones"
+    )
+    run_parser.set_defaults(func=run)
+
+    compare_parser = commands.add_parser("compare", help="compare the results of two runs")
+    compare_parser.add_argument("before", type=Path)
+    compare_parser.add_argument("after", type=Path)
+    compare_parser.add_argument(
+        "--threshold", type=float, default=10.0, help="change (in percent) above which a metric is reported"
+    )
+    compare_parser.set_defaults(func=compare)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
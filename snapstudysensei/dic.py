@@ -1,15 +1,25 @@
 import colorsys
 import gzip
+import json
+import mmap
+import os
+import shutil
+import struct
 import sys
 import tempfile
 import xml.etree.ElementTree as ET
-from collections import defaultdict
+from array import array
+from bisect import bisect_left, bisect_right
 from dataclasses import asdict, dataclass
+from functools import lru_cache
 from pathlib import Path
+from typing import BinaryIO, Iterator
 from urllib.request import urlretrieve
 
 from xdg_base_dirs import xdg_data_home
 
+from snapstudysensei import trace
+
 
 @dataclass(slots=True)
 class _Entry:
@@ -19,6 +29,113 @@ class _Entry:
     senses: str
 
 
+class _CompiledDB:
+    """
+    Memory-mapped binary form of the dictionary.
+
+    The file is made of a fixed header followed by the sections listed in
+    SECTIONS, each aligned on 8 bytes:
+    - keys: all the headwords and readings, sorted, as one UTF-8 "\\n"
+      separated text
+    - key_starts: character offset of every key in the decoded keys text,
+      with one extra trailing offset (uint32)
+    - post_starts: index of the first posting of every key, with one extra
+      trailing index (uint32)
+    - postings: (priority, entry id) pairs, sorted for each key (uint32)
+    - entry_starts: byte offset of every entry payload, with one extra
+      trailing offset (uint32)
+    - entries: the entry payloads, JSON encoded
+    - suffixes: suffix array of the keys text, that is the character offset
+      of every suffix of every key, sorted by the suffix content (uint32)
+    """
+
+    MAGIC = b"SSSJMdic"
+    VERSION = 2
+    SECTIONS = ("keys", "key_starts", "post_starts", "postings", "entry_starts", "entries", "suffixes")
+    HEADER = struct.Struct("<8sIIQQ" + "QQ" * len(SECTIONS))
+    ALIGN = 8
+
+    def __init__(self, mm: mmap.mmap, sections: dict[str, memoryview]):
+        self._mmap = mm
+        self.keys = bytes(sections["keys"]).decode("utf-8")
+        self.key_starts = sections["key_starts"].cast("I")
+        self.post_starts = sections["post_starts"].cast("I")
+        self.postings = sections["postings"].cast("I")
+        self.entry_starts = sections["entry_starts"].cast("I")
+        self._entries = sections["entries"]
+        self.suffixes = sections["suffixes"].cast("I")
+
+    @staticmethod
+    def _source_id(src_path: Path) -> tuple[int, int]:
+        stat = src_path.stat()
+        return stat.st_size, stat.st_mtime_ns
+
+    @classmethod
+    def open(cls, path: Path, src_path: Path):
+        """Map the compiled file, or return None if it is missing or stale"""
+        try:
+            with open(path, "rb") as f:
+                mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (FileNotFoundError, ValueError):  # ValueError: empty file
+            return None
+
+        if len(mm) < cls.HEADER.size:
+            return None
+        magic, version, _, src_size, src_mtime, *ranges = cls.HEADER.unpack_from(mm)
+        if magic != cls.MAGIC or version != cls.VERSION or (src_size, src_mtime) != cls._source_id(src_path):
+            return None
+
+        view = memoryview(mm)
+        sections = {}
+        for name, offset, size in zip(cls.SECTIONS, ranges[::2], ranges[1::2]):
+            if offset + size > len(mm):
+                return None
+            sections[name] = view[offset : offset + size]
+        return cls(mm, sections)
+
+    @staticmethod
+    def _section_size(data: bytes | BinaryIO) -> int:
+        if isinstance(data, bytes):
+            return len(data)
+        return data.seek(0, os.SEEK_END)
+
+    @classmethod
+    def write(cls, path: Path, src_path: Path, sections: dict[str, bytes | BinaryIO]):
+        """Atomically write a compiled file for the given source; sections can be files to stream from"""
+        ranges = []
+        offset = cls.HEADER.size
+        for name in cls.SECTIONS:
+            offset += -offset % cls.ALIGN
+            size = cls._section_size(sections[name])
+            ranges += [offset, size]
+            offset += size
+
+        tmp_path = path.with_suffix(".tmp")
+        with open(tmp_path, "wb") as f:
+            f.write(cls.HEADER.pack(cls.MAGIC, cls.VERSION, 0, *cls._source_id(src_path), *ranges))
+            for name in cls.SECTIONS:
+                f.write(bytes(-f.tell() % cls.ALIGN))
+                data = sections[name]
+                if isinstance(data, bytes):
+                    f.write(data)
+                else:
+                    data.seek(0)
+                    shutil.copyfileobj(data, f)
+        os.replace(tmp_path, path)
+
+    def get_entry(self, entry_id: int):
+        start, end = self.entry_starts[entry_id], self.entry_starts[entry_id + 1]
+        return json.loads(bytes(self._entries[start:end]))
+
+    def get_key(self, key_id: int) -> str:
+        return self.keys[self.key_starts[key_id] : self.key_starts[key_id + 1] - 1]
+
+    def get_postings(self, key_id: int) -> list[tuple[int, int]]:
+        start, end = self.post_starts[key_id] * 2, self.post_starts[key_id + 1] * 2
+        postings = self.postings[start:end]
+        return list(zip(postings[::2], postings[1::2]))
+
+
 # https://www.edrdg.org/wiki/index.php/JMdict-EDICT_Dictionary_Project
 class JDictionary:
     #  JMdict file with only English glosses with example sentence pairs from
@@ -26,6 +143,10 @@ class JDictionary:
     DB_NAME = "JMdict_e_examp"
     URL = f"http://ftp.edrdg.org/pub/Nihongo/{DB_NAME}.gz"
 
+    # Number of entries to render at once when browsing results
+    PAGE_SIZE = 50
+    RENDER_CACHE_SIZE = 1024
+
     def __init__(self):
         self._markers = self._get_frequency_markers()
 
@@ -35,24 +156,119 @@ class JDictionary:
         if not db_path.exists():
             filename, headers = urlretrieve(self.URL, reporthook=self._report_progress)
             with open(db_path, "wb") as dst, gzip.open(filename, "rb") as src:
-                dst.write(src.read())
+                shutil.copyfileobj(src, dst)
         print(f"{self.DB_NAME}: downloaded")
 
-        # Parse XML
-        tree = ET.parse(db_path)
-        self._xml_root = tree.getroot()
+        # Load the compiled form of the database, (re)building it if the XML
+        # changed since the last compilation
+        cache_path = db_path.with_suffix(".cache")
+        self._db = _CompiledDB.open(cache_path, db_path)
+        if self._db is None:
+            print(f"{self.DB_NAME}: compiling")
+            self._compile(cache_path, db_path)
+            self._db = _CompiledDB.open(cache_path, db_path)
+            assert self._db is not None
+
+        # Rendering is lazy and often repeated for the same entries while
+        # browsing, so keep the most recent ones around
+        self._render_entry = lru_cache(maxsize=self.RENDER_CACHE_SIZE)(self._render_entry)
+
+    @classmethod
+    @trace.traced("dic.compile")
+    def _compile(cls, cache_path: Path, db_path: Path):
+        # The index is accumulated as packed (key id, priority, entry id)
+        # integers rather than Python containers to keep the build compact
+        key_ids = {}
+        packed_postings = array("Q")
+
+        # Entry payloads are streamed to a temporary file as they are parsed
+        entries = tempfile.TemporaryFile()
+        entry_starts = array("I", [0])
 
-        # Build index
-        self._index = defaultdict(list)
-        for i, entry in enumerate(self._xml_root):
-            assert entry.tag == "entry"
+        entry_id = 0
+        context = ET.iterparse(db_path, events=("start", "end"))
+        _, root = next(context)
+        for event, entry in context:
+            if event != "end" or entry.tag != "entry":
+                continue
+            keys = dict(k=[], r=[])
             for source in "kr":  # kanji, then reading
-                for ele in entry.findall(source + "_ele"):
+                for ele in entry.iterfind(source + "_ele"):
                     eb = ele.find(source + "eb")  # element "body"?
                     assert eb is not None
                     e_pri = ele.findall(source + "e_pri")
-                    priority = self._get_priority_score(e_pri)
-                    self._index[eb.text].append((priority, i))
+                    priority = cls._get_priority_score(e_pri)
+                    key_id = key_ids.setdefault(eb.text, len(key_ids))
+                    packed_postings.append(key_id << 40 | priority << 32 | entry_id)
+                    keys[source].append(eb.text)
+            senses = []
+            for sense in entry.iterfind("sense"):
+                glosses = [gloss.text for gloss in sense.iterfind("gloss")]
+                pos = [pos.text for pos in sense.iterfind("pos")]
+                senses.append((glosses, pos))
+            payload = json.dumps((keys["k"], keys["r"], senses), ensure_ascii=False).encode("utf-8")
+            entry_starts.append(entry_starts[-1] + entries.write(payload))
+            entry_id += 1
+
+            # Drop the parsed entries from the tree
+            root.clear()
+
+        # Renumber the keys in their sorted order and sort the postings
+        # accordingly, which also sorts them per key by (priority, entry id)
+        keys = sorted(key_ids.keys())
+        key_ranks = array("Q", bytes(8 * len(keys)))
+        for rank, key in enumerate(keys):
+            key_ranks[key_ids[key]] = rank
+        del key_ids
+        for i, packed in enumerate(packed_postings):
+            packed_postings[i] = key_ranks[packed >> 40] << 40 | packed & 0xFF_FFFF_FFFF
+        del key_ranks
+        packed_postings = array("Q", sorted(packed_postings))
+
+        # Flatten the index
+        key_starts = array("I")
+        post_starts = array("I")
+        postings = array("I")
+        offset = 0
+        for packed in packed_postings:
+            key_id = packed >> 40
+            while len(key_starts) <= key_id:
+                key_starts.append(offset)
+                post_starts.append(len(postings) // 2)
+                offset += len(keys[len(key_starts) - 1]) + 1
+            postings += array("I", ((packed >> 32) & 0xFF, packed & 0xFFFF_FFFF))
+        key_starts.append(offset)
+        post_starts.append(len(postings) // 2)
+        del packed_postings
+
+        sections = dict(
+            keys="\n".join(keys).encode("utf-8"),
+            key_starts=key_starts.tobytes(),
+            post_starts=post_starts.tobytes(),
+            postings=postings.tobytes(),
+            entry_starts=entry_starts.tobytes(),
+            entries=entries,
+            suffixes=cls._build_suffix_array(keys).tobytes(),
+        )
+        _CompiledDB.write(cache_path, db_path, sections)
+        entries.close()
+
+    @staticmethod
+    def _build_suffix_array(keys: list[str]) -> array:
+        # Suffixes are bucketed by their first character so that only one
+        # bucket of suffix strings is alive at a time while sorting
+        buckets = {}
+        offset = 0
+        for key in keys:
+            for i, c in enumerate(key):
+                buckets.setdefault(c, array("I")).append(offset + i)
+            offset += len(key) + 1
+
+        text = "\n".join(keys) + "\n"
+        suffixes = array("I")
+        for c in sorted(buckets.keys()):
+            suffixes += array("I", sorted(buckets.pop(c), key=lambda pos: text[pos : text.index("\n", pos)]))
+        return suffixes
 
     @staticmethod
     def _report_progress(chunk_nr: int, max_chunk_size: int, total_size: int):
@@ -107,60 +323,109 @@ class JDictionary:
         marker_id = self._clamp(marker_id, 0, len(self._markers) - 1)
         return self._markers[marker_id]
 
-    def __call__(self, word: str) -> list[dict[str, str]]:
-        entries = []
+    def _find_keys(self, word: str) -> Iterator[int]:
+        """Yield the IDs of the keys matching exactly, then starting with, then containing the word"""
+        if not word:
+            return
 
-        # All potential keys
-        keys = [k for k in self._index.keys() if word in k]
+        db = self._db
+        nb_keys = len(db.key_starts) - 1
+        size = len(word)
 
-        # Exact match
-        entries += sorted(self._index.get(word, []))
+        # Keys are sorted, so the ones starting with the word are contiguous
+        start = bisect_left(range(nb_keys), word, key=db.get_key)
+        end = bisect_right(range(start, nb_keys), word, key=lambda key_id: db.get_key(key_id)[:size]) + start
+        prefix = range(start, end)
+        yield from prefix  # the exact match, if any, is the first one
 
-        # Other match starting with the word
-        for key in keys:
-            if key.startswith(word) and key != word:
-                entries += sorted(self._index.get(key, []))
+        # Same for the suffixes containing the word at their beginning
+        keys = db.keys
+        suffixes = db.suffixes
+        key_of_suffix = lambda i: keys[suffixes[i] : suffixes[i] + size]
+        start = bisect_left(range(len(suffixes)), word, key=key_of_suffix)
+        end = bisect_right(range(start, len(suffixes)), word, key=key_of_suffix) + start
+        seen = set()
+        for i in range(start, end):
+            pos = suffixes[i]
+            key_id = bisect_right(db.key_starts, pos) - 1
+            if db.key_starts[key_id] != pos and key_id not in prefix and key_id not in seen:
+                seen.add(key_id)
+                yield key_id
 
-        # Remaining matches
-        for key in keys:
-            if not key.startswith(word) and key != word:
-                entries += sorted(self._index.get(key, []))
+    @trace.traced("dic.scan")
+    def scan(self, sentence: str) -> list[tuple[int, int, str]]:
+        """
+        Find all the keys present in the sentence, as (start, end, key)
+        tuples sorted by start and then longest match first.
 
-        ret = []
-        for priority, entry_id in entries:
-            xml_entry = self._xml_root[entry_id]
+        The sorted keys are walked as an implicit trie: from every position
+        of the sentence, the range of keys sharing the prefix read so far is
+        narrowed one character at a time until it is empty.
+        """
+        db = self._db
+        nb_keys = len(db.key_starts) - 1
+        hits = []
+        for start in range(len(sentence)):
+            lo, hi = 0, nb_keys
+            matches = []
+            for end in range(start + 1, len(sentence) + 1):
+                prefix = sentence[start:end]
+                size = len(prefix)
+                lo = bisect_left(range(lo, hi), prefix, key=db.get_key) + lo
+                hi = bisect_right(range(lo, hi), prefix, key=lambda key_id: db.get_key(key_id)[:size]) + lo
+                if lo == hi:
+                    break
+                if db.get_key(lo) == prefix:
+                    matches.append((start, end, prefix))
+            hits += reversed(matches)
+        return hits
 
-            keys = []
-            colors = dict(k="darkslategray", r="dimgray")
-            reading = ""
-            for source in "kr":  # kanji, then reading
-                color = colors[source]
-                for ele in xml_entry.findall(source + "_ele"):
-                    eb = ele.find(source + "eb")
-                    assert eb is not None
-                    keys.append(f'<font color="{color}">{eb.text}</font>')
-                    if not reading and source == "r":
-                        reading = eb.text
-
-            rich_title = self._get_frequency_marker(priority) + ", ".join(keys)
-            assert reading is not None
-
-            senses_list = []
-            rich_content = "<ol>"
-            for i, sense in enumerate(xml_entry.findall("sense")):
-                tags = "".join(f'<li><font color="gray">{pos.text}</font></li>' for pos in sense.findall("pos"))
-                if tags:
-                    tags = f"<ul>{tags}</ul>"
-                glosses = ", ".join(gloss.text for gloss in sense.findall("gloss"))
-                rich_content += f"<li>{glosses}{tags}</li>"
-                senses_list.append(glosses)
-            rich_content += "</ol>"
-
-            if len(senses_list) > 1:
-                senses = "\n".join(f"{i}. {sense}" for i, sense in enumerate(senses_list, 1))
-            else:
-                senses = senses_list[0]
-
-            ret.append(asdict(_Entry(rich_title, rich_content, reading, senses)))
-
-        return ret
+    def scan_longest(self, sentence: str) -> list[tuple[int, int, str]]:
+        """Longest dictionary word found at every position of the sentence, as (start, end, word) tuples"""
+        words = []
+        last_start = -1
+        for start, end, word in self.scan(sentence):
+            if start != last_start:
+                words.append((start, end, word))
+                last_start = start
+        return words
+
+    def _render_entry(self, priority: int, entry_id: int) -> _Entry:
+        kanjis, readings, senses_data = self._db.get_entry(entry_id)
+
+        keys = []
+        colors = dict(k="darkslategray", r="dimgray")
+        for source, texts in zip("kr", (kanjis, readings)):  # kanji, then reading
+            color = colors[source]
+            for text in texts:
+                keys.append(f'<font color="{color}">{text}</font>')
+        reading = readings[0] if readings else ""
+
+        rich_title = self._get_frequency_marker(priority) + ", ".join(keys)
+
+        senses_list = []
+        rich_content = "<ol>"
+        for glosses, pos in senses_data:
+            tags = "".join(f'<li><font color="gray">{tag}</font></li>' for tag in pos)
+            if tags:
+                tags = f"<ul>{tags}</ul>"
+            glosses = ", ".join(glosses)
+            rich_content += f"<li>{glosses}{tags}</li>"
+            senses_list.append(glosses)
+        rich_content += "</ol>"
+
+        if len(senses_list) > 1:
+            senses = "\n".join(f"{i}. {sense}" for i, sense in enumerate(senses_list, 1))
+        else:
+            senses = senses_list[0]
+
+        return _Entry(rich_title, rich_content, reading, senses)
+
+    def lookup(self, word: str) -> Iterator[dict[str, str]]:
+        """Lazily render the entries matching the word, best matches first"""
+        for key_id in self._find_keys(word):
+            for priority, entry_id in self._db.get_postings(key_id):
+                yield asdict(self._render_entry(priority, entry_id))
+
+    def __call__(self, word: str) -> list[dict[str, str]]:
+        return list(self.lookup(word))
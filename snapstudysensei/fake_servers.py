@@ -0,0 +1,139 @@
+"""
+Local stand-ins of the HTTP services used by SnapStudySensei, for the
+self-checks and the benchmarks.
+"""
+
+import itertools
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+
+class _FakeServer:
+    """HTTP server answering from a background thread, on a free local port"""
+
+    def __init__(self):
+        fake = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+            # The headers and the body are written separately, which would
+            # otherwise stall on delayed ACKs
+            disable_nagle_algorithm = True
+
+            def do_GET(self):
+                fake._reply(self, *fake._get(self.path))
+
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers["Content-Length"]))
+                fake._reply(self, *fake._post(self.path, body))
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.port = self._server.server_address[1]
+        self.url = f"http://127.0.0.1:{self.port}"
+        threading.Thread(target=self._server.serve_forever, daemon=True).start()
+
+    @staticmethod
+    def _reply(handler: BaseHTTPRequestHandler, status: int, content_type: str, data: bytes):
+        handler.send_response(status)
+        handler.send_header("Content-Type", content_type)
+        handler.send_header("Content-Length", str(len(data)))
+        handler.end_headers()
+        handler.wfile.write(data)
+
+    def _get(self, path: str) -> tuple[int, str, bytes]:
+        return 405, "text/plain", b""
+
+    def _post(self, path: str, body: bytes) -> tuple[int, str, bytes]:
+        return 405, "text/plain", b""
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
+
+
+class FakeAnkiConnect(_FakeServer):
+    """
+    Minimal in-memory AnkiConnect server, implementing the actions used by
+    AnkiConnect. Like the real one, requests without a version get the
+    results of version 4, which are not wrapped in {result, error}. Notes
+    with an empty Word field are rejected.
+    """
+
+    def __init__(self):
+        self._notes: dict[int, dict] = {}
+        self._ids = itertools.count(1)
+        self._lock = threading.RLock()  # multi runs the actions recursively
+        super().__init__()
+
+    def _post(self, path: str, body: bytes) -> tuple[int, str, bytes]:
+        data = json.dumps(self._handle(json.loads(body))).encode("utf-8")
+        return 200, "application/json", data
+
+    def _handle(self, request: dict):
+        try:
+            result = self._run(request["action"], request.get("params", {}))
+        except Exception as e:
+            return dict(result=None, error=str(e))
+        return dict(result=result, error=None) if request.get("version", 4) > 4 else result
+
+    def _run(self, action: str, params: dict):
+        with self._lock:
+            if action == "multi":
+                return [self._handle(request) for request in params["actions"]]
+            if action in ("deckNamesAndIds", "modelNamesAndIds"):
+                return {}
+            if action in ("createDeck", "createModel"):
+                return 1
+            if action == "getMediaDirPath":
+                return "/nonexistent"
+            if action == "getMediaFilesNames":
+                return []
+            if action == "addNotes":
+                anki_ids = []
+                for note in params["notes"]:
+                    if not note["fields"].get("Word"):
+                        anki_ids.append(None)
+                        continue
+                    anki_id = next(self._ids)
+                    fields = dict(ContextPicture="", WordAudio="") | note["fields"]
+                    self._notes[anki_id] = dict(noteId=anki_id, fields={k: dict(value=v) for k, v in fields.items()})
+                    anki_ids.append(anki_id)
+                return anki_ids
+            if action == "findNotes":
+                return list(self._notes)
+            if action == "notesInfo":
+                return [self._notes[anki_id] for anki_id in params["notes"]]
+            if action == "deleteNotes":
+                for anki_id in params["notes"]:
+                    self._notes.pop(anki_id, None)
+                return None
+        raise Exception(f"unsupported action {action}")
+
+
+class FakeAudioServer(_FakeServer):
+    """
+    Stand-in of the Pod101 audio endpoint: serves the clip of the requested
+    kanji, or the no_audio clip for the unknown ones. The requests for the
+    stalled words are only answered after stall_time seconds.
+    """
+
+    def __init__(self, clips: dict[str, bytes], no_audio: bytes, stalled: set[str] = frozenset(), stall_time=30):
+        self._clips = clips
+        self._no_audio = no_audio
+        self._stalled = stalled
+        self._stall_time = stall_time
+        self.requests = 0
+        super().__init__()
+
+    def _get(self, path: str) -> tuple[int, str, bytes]:
+        self.requests += 1
+        kanji = parse_qs(urlparse(path).query).get("kanji", [""])[0]
+        if kanji in self._stalled:
+            time.sleep(self._stall_time)
+        return 200, "audio/mpeg", self._clips.get(kanji, self._no_audio)
@@ -1,44 +1,156 @@
 import sys
-import tempfile
-from operator import itemgetter
+from concurrent.futures import Future, ThreadPoolExecutor
+from functools import partial
+from itertools import islice
 from pathlib import Path
+from typing import TYPE_CHECKING
 
-from PIL import Image
-from PySide6.QtCore import QRect, QRectF, Slot
-from PySide6.QtGui import QGuiApplication, QPixmap
+from PySide6.QtCore import QObject, QRect, QRectF, QSocketNotifier, QTimer, Signal, Slot
+from PySide6.QtGui import QGuiApplication, QImage
 from PySide6.QtQml import QQmlApplicationEngine
 
 import snapstudysensei.window_capture
-from snapstudysensei.anki import AnkiConnect, AnkiNote
+from snapstudysensei import trace
+from snapstudysensei.anki import AnkiConnect, AnkiMirror, AnkiNote, AnkiQueue
 from snapstudysensei.dic import JDictionary
-from snapstudysensei.ocr import OCRWrapper
+from snapstudysensei.picture import PictureEncoder
+from snapstudysensei.qimage_view import to_pil
 from snapstudysensei.snapshot_provider import SnapshotProvider
 from snapstudysensei.tts import TTSWrapper
 from snapstudysensei.windows_list import WindowsList
 
+if TYPE_CHECKING:
+    # Importing the OCR pulls the whole ML stack, which is done in the
+    # background at startup
+    from snapstudysensei.ocr import OCRWrapper
 
-class SnapStudySensei:
-    def __init__(self, app, ocr: OCRWrapper, dic: JDictionary, tts: TTSWrapper):
+
+class _OCRWorker(QObject):
+    """Run OCR requests in a background thread, only honoring the latest one"""
+
+    textReady = Signal(int, str)
+
+    def __init__(self, ocr: "OCRWrapper"):
+        super().__init__()
         self._ocr = ocr
-        self._dic = dic
-        self._tts = tts
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ocr")
+        self._pending: Future | None = None
+        self.request_id = 0
+
+        # Paid for in the OCR thread rather than while loading, a selection
+        # made in the meantime only waits for its end
+        self._executor.submit(self._warmup)
+
+    def _warmup(self):
+        try:
+            self._ocr.warmup()
+        except Exception as e:
+            print(f"unable to warm up the OCR: {e}", file=sys.stderr)
+
+    def submit(self, image: QImage):
+        """Queue a new request, superseding the previous one"""
+        if self._pending is not None:
+            self._pending.cancel()  # only effective if it didn't start yet
+        self.request_id += 1
+        self._pending = self._executor.submit(self._run, self.request_id, image)
+
+    def _run(self, request_id: int, image: QImage):
+        if request_id != self.request_id:
+            return
+        try:
+            with trace.span("ocr.convert"):
+                pil_image = to_pil(image)
+            text = self._ocr(pil_image)
+        except Exception as e:
+            # Clear the previous sentence rather than leaving it as the result
+            print(f"unable to read the selection: {e}", file=sys.stderr)
+            text = ""
+        self.textReady.emit(request_id, text)
+
+    def shutdown(self):
+        self.request_id += 1
+        self._executor.shutdown(wait=True, cancel_futures=True)
+
+
+class _BackendsLoader(QObject):
+    """Deliver the backends initialized in background threads to the GUI thread"""
+
+    loaded = Signal(str, object)
+
+    def watch(self, backends: dict[str, Future]):
+        for name, future in backends.items():
+            future.add_done_callback(partial(self._done, name))
+
+    def _done(self, name: str, future: Future):
+        self.loaded.emit(name, future)
+
+
+class _AnkiSync(QObject):
+    """Synchronize the local Anki mirror in a background thread"""
+
+    synced = Signal(object, object)
+
+    def __init__(self, anki: AnkiConnect, mirror: AnkiMirror):
+        super().__init__()
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="anki-sync")
+        self._executor.submit(self._run, anki, mirror)
+        self._executor.shutdown(wait=False)
+
+    def _run(self, anki: AnkiConnect, mirror: AnkiMirror):
+        try:
+            notes, removed_ids = mirror.sync(anki)
+        except Exception as e:
+            print(f"unable to synchronize Anki notes: {e}", file=sys.stderr)
+            return
+        self.synced.emit(notes, removed_ids)
+
+
+class _AnkiQueueListener(QObject):
+    """Forward the notes processed by the Anki queue thread to the GUI thread"""
+
+    done = Signal(str, object)
+
+
+class _AudioListener(QObject):
+    """Forward the audio fetched by the TTS threads to the GUI thread"""
+
+    fetched = Signal(object, object)
+
+
+class SnapStudySensei:
+    def __init__(self, app, backends: dict[str, Future]):
+        # Backends are set as soon as their initialization completes
+        self._ocr: _OCRWorker | None = None
+        self._dic: JDictionary | None = None
+        self._tts: TTSWrapper | None = None
+        self._pending_word = None
 
         self._include_screenshot = True
+        self._crop_screenshot = False
+        try:
+            self._picture_encoder = PictureEncoder.from_env()
+        except ValueError as e:
+            print(f"invalid picture settings, using the default ones: {e}", file=sys.stderr)
+            self._picture_encoder = PictureEncoder()
+        self._selection = None
+        self._word_info = iter([])
         self._audio = None
+        self._audio_request = None
+        self._audio_listener = _AudioListener()
+        self._audio_listener.fetched.connect(self._audio_fetched)
         self._anki = AnkiConnect()
-        self._tempdir = Path(tempfile.gettempdir())
+        self._anki_mirror = AnkiMirror()
+        # Requests made on behalf of the UI, which mustn't wait for Anki
+        self._anki_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="anki")
+        self._cancelled_records = set()
 
         self._snapshot_provider = SnapshotProvider()
         self._snapshot_provider.snapshotTaken.connect(self._snapshot_taken)
-        self._snapshot = None
+        self._snapshot = self._snapshot_provider.store
 
         self._engine = QQmlApplicationEngine()
         self._engine.addImageProvider("snapshot", self._snapshot_provider)
 
-        # Init capture windows list
-        self._winlist = WindowsList()
-        self._update_windows_list_model()  # make sure the model is set before loading the QML
-
         # Load QML
         qml_file = Path(__file__).parent / "main.qml"
         self._engine.load(qml_file)
@@ -47,77 +159,189 @@ class SnapStudySensei:
             sys.exit(-1)
         self._window = root_objects[0]
 
-        # Fill all records grabbed from Anki
-        notes = self._anki.list_notes()
+        # Fill all records from the local mirror, and update them once it is
+        # synchronized with Anki
+        notes = self._anki_mirror.list_notes()
         records = [note.get_qml_record() for note in notes]
         self._window.add_records(records)
+        self._anki_sync = _AnkiSync(self._anki, self._anki_mirror)
+        self._anki_sync.synced.connect(self._anki_synced)
+
+        # Notes are added to Anki in the background; the ones which were
+        # still pending when the application was closed are resubmitted
+        self._anki_queue_listener = _AnkiQueueListener()
+        self._anki_queue_listener.done.connect(self._record_added)
+        self._anki_queue = AnkiQueue(self._anki, self._anki_queue_listener.done.emit)
+        pending = self._anki_queue.get_pending()
+        self._window.add_records([note.get_qml_record(pending_id) for pending_id, note in pending.items()])
+
+        # Init capture windows list, then follow its changes from the X events
+        self._winlist = WindowsList()
+        self._winlist.watch()
+        self._windows_list_refresh()
+        self._winlist_notifier = QSocketNotifier(self._winlist.fileno(), QSocketNotifier.Read)
+        self._winlist_notifier.activated.connect(self._windows_list_events)
 
         # Connect signals from the QML
         self._window.requestWindowsListRefresh.connect(self._windows_list_refresh)
         self._window.selectionMade.connect(self._selection_made)
         self._window.wordSelected.connect(self._word_selected)
+        self._window.requestMoreWordInfo.connect(self._more_word_info)
         self._window.requestRecordAdd.connect(self._record_add)
         self._window.recordRemoved.connect(self._record_remove)
         self._window.includeScreenshotToggled.connect(self._include_screenshot_toggled)
+        self._window.cropScreenshotToggled.connect(self._crop_screenshot_toggled)
         self._window.audioSourceChanged.connect(self._audio_source_changed)
+        self._window.wordEntryPicked.connect(self._word_entry_picked)
+
+        # Only watch the backends once the window exists since the callbacks
+        # are called immediately for already initialized ones
+        self._backends_loader = _BackendsLoader()
+        self._backends_loader.loaded.connect(self._backend_loaded)
+        self._backends_loader.watch(backends)
+
+        # Debug overlay with the statistics of the traced stages
+        if trace.ENABLED:
+            self._trace_timer = QTimer()
+            self._trace_timer.setInterval(1000)
+            self._trace_timer.timeout.connect(lambda: self._window.set_trace_stats(trace.get_stats()))
+            self._trace_timer.start()
+
+    @Slot(str, object)
+    def _backend_loaded(self, name: str, future: Future):
+        try:
+            backend = future.result()
+        except Exception as e:
+            print(f"unable to initialize {name}: {e}", file=sys.stderr)
+            self._window.set_backend_state(name, "failed")
+            return
+
+        if name == "ocr":
+            self._ocr = _OCRWorker(backend)
+            self._ocr.textReady.connect(self._ocr_done)
+        elif name == "dic":
+            self._dic = backend
+            if self._pending_word is not None:
+                self._word_selected(self._pending_word)
+        elif name == "tts":
+            self._tts = backend
+        self._window.set_backend_state(name, "ready")
+
+    def shutdown(self):
+        if self._ocr is not None:
+            self._ocr.shutdown()
+        self._anki_queue.close()
+        self._anki_executor.shutdown(wait=True)
+        if self._tts is not None:
+            self._tts.shutdown()
 
     @Slot(str, str, str, str)
     def _record_add(self, sentence: str, word: str, reading: str, meaning: str):
-        if self._snapshot is not None and self._include_screenshot:
-            picture = Image.fromqpixmap(self._snapshot) if self._snapshot else None
-            picture_path = self._tempdir / "SnapStudySensei.png"
-            picture.save(picture_path)
-        else:
-            picture_path = None
+        # The picture is encoded from the queue thread; QImage (unlike
+        # QPixmap) can be used outside the GUI thread
+        encode_picture = None
+        if not self._snapshot.isNull() and self._include_screenshot:
+            image = self._snapshot.frame
+            selection = self._selection if self._crop_screenshot else None
+            encode_picture = partial(self._picture_encoder, image, selection)
 
         note = AnkiNote(
             word=word,
-            context_picture=picture_path,
+            context_picture=None,
             context_sentence=sentence,
             word_reading=reading,
             word_glossary=meaning,
             word_audio=self._audio,
         )
-        note = self._anki.add_note(note)
-        self._window.add_records([note.get_qml_record()])
+        pending_id = self._anki_queue.submit(note, encode_picture)
+        self._window.add_records([note.get_qml_record(pending_id)])
+
+    @Slot(str, object)
+    def _record_added(self, pending_id: str, note: AnkiNote | None):
+        if note is None:
+            self._cancelled_records.discard(pending_id)
+            print("note rejected by Anki", file=sys.stderr)
+            self._window.remove_records([pending_id])
+        elif pending_id in self._cancelled_records:
+            # Removed while it was being submitted
+            self._cancelled_records.discard(pending_id)
+            self._remove_anki_note(note.anki_id)
+            # In case the synchronization got it in the meantime
+            self._anki_mirror.remove_notes([note.anki_id])
+            self._window.remove_records([str(note.anki_id)])
+        else:
+            self._anki_mirror.put_notes([note])
+            self._window.replace_record(pending_id, note.get_qml_record())
 
     @Slot(str)
     def _record_remove(self, record_id: str):
+        if record_id.startswith(AnkiQueue.PENDING_PREFIX):
+            if not self._anki_queue.cancel(record_id):
+                self._cancelled_records.add(record_id)
+            return
         anki_id = int(record_id)
-        self._anki.remove_note(anki_id)
-
-    def _update_windows_list_model(self) -> list[dict[str, str | int]]:
-        """Rebuild the list of windows entirely"""
-        windows = self._winlist()
-        windows_list_model = [dict(title=title, wid=wid, visible=visible) for wid, (title, visible) in windows.items()]
-        windows_list_model = sorted(windows_list_model, key=lambda item: item["title"].lower())
-        windows_list_model = sorted(windows_list_model, key=itemgetter("visible"), reverse=True)
-        self._engine.rootContext().setContextProperty("windowsListModel", windows_list_model)
-        return windows_list_model
-
-    @Slot(int)
-    def _windows_list_refresh(self, wid: int):
-        windows_list_model = self._update_windows_list_model()
-
-        # Check if the previously selected window can still be found in the new windows set
-        if wid is not None:
-            ids = [window["wid"] for window in windows_list_model]
-            try:
-                self._window.set_capture_window(ids.index(wid))
-            except ValueError:
-                # This can happen when the window was closed but is still selected
-                pass
+        self._remove_anki_note(anki_id)
+        self._anki_mirror.remove_notes([anki_id])
+
+    def _remove_anki_note(self, anki_id: int):
+        future = self._anki_executor.submit(self._anki.remove_note, anki_id)
+        future.add_done_callback(self._anki_note_removed)
+
+    @staticmethod
+    def _anki_note_removed(future: Future):
+        # The note stays in the mirror until the next synchronization
+        if future.exception() is not None:
+            print(f"unable to remove the note from Anki: {future.exception()}", file=sys.stderr)
+
+    @Slot(object, object)
+    def _anki_synced(self, notes: list[AnkiNote], removed_ids: list[int]):
+        self._window.remove_records([str(anki_id) for anki_id in removed_ids])
+        self._window.update_records([note.get_qml_record() for note in notes])
+
+    def _update_windows_list_model(self, changed: dict[int, tuple[str, bool]], removed_ids: list[int]):
+        """Only push the changed entries to the model"""
+        if not changed and not removed_ids:
+            return
+        windows = [dict(title=title, wid=wid, visible=visible) for wid, (title, visible) in changed.items()]
+        self._window.update_windows(windows, removed_ids)
+
+    @Slot()
+    def _windows_list_events(self):
+        self._update_windows_list_model(*self._winlist.process_events())
+
+    @Slot()
+    def _windows_list_refresh(self):
+        self._update_windows_list_model(*self._winlist.refresh())
+        # Waiting for the replies reads the pending events into the xcb
+        # queue, where the socket notifier can't see them
+        self._windows_list_events()
+
+    @Slot(str, str)
+    def _word_entry_picked(self, word: str, reading: str):
+        if self._tts is not None:
+            self._tts.prefetch(word, reading)
 
     @Slot(str, str, str)
     def _audio_source_changed(self, audio_source: str, word: str, reading: str):
-        self._tts.set_method(audio_source)
+        self._audio = None
+        self._window.stop_audio()
+        if self._tts is None:
+            return
+        request = (audio_source, word, reading)
+        self._audio_request = request
+        future = self._tts.fetch(audio_source, word, reading)
+        future.add_done_callback(partial(self._audio_listener.fetched.emit, request))
+
+    @Slot(object, object)
+    def _audio_fetched(self, request: tuple[str, str, str], future: Future):
+        if request != self._audio_request:
+            return  # another source was selected in the meantime
         try:
-            source = self._tts(word, reading)
+            source = future.result()
         except Exception:
             print("unable to grab audio", file=sys.stderr)
             source = None
         self._audio = source
-        self._window.stop_audio()
         if source is not None:
             self._window.play_audio(source.as_posix())
 
@@ -125,37 +349,69 @@ class SnapStudySensei:
     def _include_screenshot_toggled(self, value: bool):
         self._include_screenshot = value
 
-    @Slot(QPixmap)
-    def _snapshot_taken(self, pixmap: QPixmap):
-        self._snapshot = pixmap
+    @Slot(bool)
+    def _crop_screenshot_toggled(self, value: bool):
+        self._crop_screenshot = value
+
+    @Slot()
+    def _snapshot_taken(self):
+        self._selection = None
+        frame = self._snapshot.frame
+        size_mib = self._snapshot.memory_usage() / (1024 * 1024)
+        self._window.set_snapshot_info(f"{frame.width()}×{frame.height()}, {size_mib:.1f} MiB")
 
     @Slot(QRectF)
     def _selection_made(self, rectf: QRectF):
-        if not self._snapshot:
+        if self._snapshot.isNull() or self._ocr is None:
             return
 
-        snapshot = self._snapshot
+        snapshot = self._snapshot.frame
         rect = QRect(
             int(rectf.x() * snapshot.width()),
             int(rectf.y() * snapshot.height()),
             int(rectf.width() * snapshot.width()),
             int(rectf.height() * snapshot.height()),
         )
-        pixmap = self._snapshot.copy(rect)
-        image = Image.fromqpixmap(pixmap)
+        self._selection = rect
+        with trace.span("main.crop"):
+            crop = self._snapshot.crop(rect)
+        self._ocr.submit(crop)
+
+    @Slot(int, str)
+    def _ocr_done(self, request_id: int, text: str):
+        if request_id != self._ocr.request_id:
+            return  # a more recent selection was made in the meantime
+        text = text.strip()
+        self._window.set_sentence(text)
+        if self._dic is not None:
+            self._window.set_word_candidates(self._get_word_candidates(text))
 
-        text = self._ocr(image)
-        self._window.set_sentence(text.strip())
+    def _get_word_candidates(self, sentence: str) -> list[dict[str, str | int]]:
+        return [dict(start=start, end=end, word=word) for start, end, word in self._dic.scan_longest(sentence)]
 
     @Slot(str)
     def _word_selected(self, word: str):
-        info = self._dic(word)
+        if self._dic is None:
+            self._pending_word = word  # looked up once the dictionary is loaded
+            return
+        self._pending_word = None
+        self._word_info = self._dic.lookup(word)
+        with trace.span("dic.lookup"):
+            info = list(islice(self._word_info, self._dic.PAGE_SIZE))
         self._window.set_word_info(info)
 
+    @Slot()
+    def _more_word_info(self):
+        with trace.span("dic.lookup"):
+            info = list(islice(self._word_info, self._dic.PAGE_SIZE))
+        if info:
+            self._window.add_word_info(info)
+
 
-def run(ocr: OCRWrapper, dic: JDictionary, tts: TTSWrapper):
+def run(backends: dict[str, Future]):
     app = QGuiApplication(sys.argv)
-    sss = SnapStudySensei(app, ocr, dic, tts)
+    sss = SnapStudySensei(app, backends)
     ret = app.exec()
+    sss.shutdown()
     del sss
     sys.exit(ret)
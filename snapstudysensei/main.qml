@@ -12,22 +12,94 @@ ApplicationWindow {
     height: 800
     visible: true
 
-    signal requestWindowsListRefresh(int current_wid)
+    signal requestWindowsListRefresh()
     signal selectionMade(rect rect)
     signal wordSelected(string word)
+    signal requestMoreWordInfo()
     signal requestRecordAdd(string sentence, string word, string reading, string meaning)
     signal recordRemoved(string record_id)
     signal includeScreenshotToggled(bool value)
+    signal cropScreenshotToggled(bool value)
     signal audioSourceChanged(string audio_id, string word, string reading)
+    signal wordEntryPicked(string word, string reading)
+
+    function set_backend_state(name, state) { root[name + "_state"] = state; }
+    function find_window(wid) {
+        for (let i = 0; i < windowsListModel.count; i++)
+            if (windowsListModel.get(i).wid === wid)
+                return i;
+        return -1;
+    }
+    function window_less_than(a, b) {
+        // Visible windows first, then by title
+        if (a.visible !== b.visible)
+            return a.visible;
+        return a.title.toLowerCase() < b.title.toLowerCase();
+    }
+    function update_windows(windows, removed_wids) {
+        const current_wid = windowsList.currentIndex >= 0 ? windowsList.currentValue : undefined;
+        for (const wid of removed_wids) {
+            const index = find_window(wid);
+            if (index >= 0)
+                windowsListModel.remove(index);
+        }
+        for (const window of windows) {
+            const index = find_window(window.wid);
+            if (index >= 0)
+                windowsListModel.remove(index);
+            let pos = 0;
+            while (pos < windowsListModel.count && !window_less_than(window, windowsListModel.get(pos)))
+                pos++;
+            windowsListModel.insert(pos, window);
+        }
 
-    function set_capture_window(index) { windowsList.currentIndex = index; }
+        // Keep the same window selected even if it moved in the list; the
+        // selection is only lost when the window is gone
+        if (current_wid === undefined) {
+            if (windowsListModel.count > 0) {
+                windowsList.currentIndex = 0;
+                windowCaptureProducer.wid = windowsList.currentValue;
+            }
+        } else {
+            const index = find_window(current_wid);
+            if (index >= 0)
+                windowsList.currentIndex = index;
+        }
+        update_capture_mapped();
+    }
+    function update_capture_mapped() {
+        // The preview is paused while the captured window is unmapped
+        const index = find_window(windowCaptureProducer.wid);
+        windowCaptureProducer.mapped = index < 0 || windowsListModel.get(index).visible;
+    }
     function set_sentence(text) { sentenceText.text = text; }
+    function set_snapshot_info(text) { snapshotInfo.text = text; }
+    function set_trace_stats(stats) { root.trace_stats = stats; }
+    function set_word_candidates(candidates) {
+        candidatesModel.clear();
+        for (const candidate of candidates)
+            candidatesModel.append(candidate);
+    }
+
+    function select_word(word) {
+        if (word != "" && word != root.selected_word) {
+            root.selected_word = word;
+            readingText.text = "";
+            meaningText.text = "";
+            reset_audio_source();
+            wordSelected(word);
+        }
+    }
     function set_word_info(info) {
         dictModel.clear();
         for (const entry of info)
             dictModel.append(entry);
         dictView.positionViewAtBeginning();
     }
+    function add_word_info(info) {
+        for (const entry of info)
+            dictModel.append(entry);
+    }
 
     function add_records(records) {
         for (const record of records)
@@ -35,6 +107,49 @@ ApplicationWindow {
         recordView.positionViewAtEnd();
     }
 
+    function find_record(record_id) {
+        for (let i = 0; i < recordModel.count; i++)
+            if (recordModel.get(i).record_id == record_id)
+                return i;
+        return -1;
+    }
+
+    function update_records(records) {
+        const added = [];
+        for (const record of records) {
+            const index = find_record(record.record_id);
+            if (index == -1)
+                added.push(record);
+            else
+                recordModel.set(index, record);
+        }
+        if (added.length)
+            add_records(added);
+    }
+
+    function replace_record(record_id, record) {
+        const index = find_record(record_id);
+        // The synchronization may have added the new record already
+        const existing = find_record(record.record_id);
+        if (existing != -1) {
+            recordModel.set(existing, record);
+            if (index != -1)
+                recordModel.remove(index, 1);
+        } else if (index == -1) {
+            add_records([record]);
+        } else {
+            recordModel.set(index, record);
+        }
+    }
+
+    function remove_records(record_ids) {
+        for (const record_id of record_ids) {
+            const index = find_record(record_id);
+            if (index != -1)
+                recordModel.remove(index, 1);
+        }
+    }
+
     function reset_audio_source() {
         audioNone.checked = true;
         audioSourceChanged("none", "", "");
@@ -52,13 +167,18 @@ ApplicationWindow {
 
     property string selected_word: ""
 
+    // Backends state: "loading", "ready" or "failed"
+    property string ocr_state: "loading"
+    property string dic_state: "loading"
+    property string tts_state: "loading"
+
+    // Statistics of the traced stages (only set when tracing is enabled)
+    property var trace_stats: []
+
     WindowCaptureProducer {
         id: windowCaptureProducer
         videoSink: videoOutput.videoSink
-    }
-    Timer {
-        interval: 100; running: true; repeat: true
-        onTriggered: windowCaptureProducer.refresh()
+        active: videoOutput.visible && root.visibility != Window.Minimized
     }
 
     SplitView {
@@ -82,17 +202,19 @@ ApplicationWindow {
                         Label { text: "Window:" }
                         ComboBox {
                             id: windowsList
-                            model: windowsListModel
+                            model: ListModel { id: windowsListModel }
                             textRole: "title"
                             valueRole: "wid"
                             Layout.fillWidth: true
-                            onActivated: windowCaptureProducer.wid = currentValue
-                            Component.onCompleted: windowCaptureProducer.wid = currentValue
+                            onActivated: {
+                                windowCaptureProducer.wid = currentValue;
+                                root.update_capture_mapped();
+                            }
                             delegate: ItemDelegate {
                                 width: windowsList.width
                                 contentItem: Text {
-                                    text: modelData[windowsList.textRole]
-                                    font.italic: !modelData["visible"]
+                                    text: model.title
+                                    font.italic: !model.visible
                                     font.bold: windowsList.currentIndex === index
                                     verticalAlignment: Text.AlignVCenter
                                 }
@@ -103,13 +225,21 @@ ApplicationWindow {
                             text: "↺"
                             background.implicitWidth: 0
                             background.implicitHeight: 0
-                            onClicked: requestWindowsListRefresh(windowsList.currentValue)
+                            onClicked: requestWindowsListRefresh()
                         }
                     }
                     VideoOutput {
                         id: videoOutput
                         Layout.fillWidth: true
                         Layout.fillHeight: true
+
+                        Label {
+                            anchors.right: parent.right
+                            anchors.bottom: parent.bottom
+                            font.pointSize: 8
+                            color: "gray"
+                            text: windowCaptureProducer.effectiveFps.toFixed(1) + " fps"
+                        }
                     }
                     Button {
                         text: "Capture →"
@@ -137,6 +267,12 @@ ApplicationWindow {
                         text: root.selected_word
                         Layout.alignment: Qt.AlignHCenter
                     }
+                    Label {
+                        visible: root.dic_state != "ready"
+                        text: root.dic_state == "loading" ? "Loading dictionary…" : "Dictionary unavailable"
+                        font.italic: true
+                        Layout.alignment: Qt.AlignHCenter
+                    }
                     ScrollView {
                         Layout.fillHeight: true
                         Layout.fillWidth: true
@@ -145,6 +281,7 @@ ApplicationWindow {
                             id: dictView
                             clip: true
                             model: ListModel { id: dictModel }
+                            onAtYEndChanged: if (atYEnd && count > 0) requestMoreWordInfo()
                             delegate: ColumnLayout {
                                 RowLayout {
                                     Button {
@@ -154,6 +291,7 @@ ApplicationWindow {
                                         onClicked: {
                                             readingText.text = model.reading != root.selected_word ? model.reading : "";
                                             meaningText.text = model.senses;
+                                            wordEntryPicked(root.selected_word, readingText.text);
                                         }
                                     }
                                     Label {
@@ -186,9 +324,19 @@ ApplicationWindow {
                     cache: false
                     Layout.alignment: Qt.AlignHCenter
 
+                    Label {
+                        id: snapshotInfo
+                        anchors.right: parent.right
+                        anchors.bottom: parent.bottom
+                        visible: captureImage.status == Image.Ready
+                        font.pointSize: 8
+                        color: "gray"
+                    }
+
                     MouseArea {
                         id: captureMouseArea
                         anchors.fill: parent
+                        enabled: root.ocr_state == "ready"
                         property point p0
                         property point p1
                         readonly property rect rect: Qt.rect(
@@ -215,28 +363,48 @@ ApplicationWindow {
                         height: captureMouseArea.rect.height
                     }
                 }
-                Label { text: "Sentence" }
+                Label {
+                    text: "Sentence" + (root.ocr_state == "loading" ? " (loading OCR…)" : root.ocr_state == "failed" ? " (OCR unavailable)" : "")
+                }
                 TextArea {
                     id: sentenceText
                     font.pointSize: 20
                     persistentSelection: true
                     Layout.fillHeight: true
                     Layout.fillWidth: true
-                    onReleased: {
-                        if (selectedText != "" && selectedText != root.selected_word) {
-                            root.selected_word = selectedText;
-                            readingText.text = "";
-                            meaningText.text = "";
-                            reset_audio_source();
-                            wordSelected(selectedText);
+                    onReleased: select_word(selectedText)
+                    background: Rectangle { radius: 2; color: "white"; border.color: "#aaa" }
+                }
+                Flow {
+                    Layout.fillWidth: true
+                    spacing: 2
+
+                    Repeater {
+                        model: ListModel { id: candidatesModel }
+                        delegate: Button {
+                            text: model.word
+                            flat: true
+                            font.bold: model.word == root.selected_word
+                            onClicked: {
+                                sentenceText.select(model.start, model.end);
+                                select_word(model.word);
+                            }
                         }
                     }
-                    background: Rectangle { radius: 2; color: "white"; border.color: "#aaa" }
                 }
-                Switch {
-                    text: "Include screenshot"
-                    checked: true
-                    onToggled: includeScreenshotToggled(checked)
+                RowLayout {
+                    Switch {
+                        id: includeScreenshotSwitch
+                        text: "Include screenshot"
+                        checked: true
+                        onToggled: includeScreenshotToggled(checked)
+                    }
+                    Switch {
+                        text: "Only around selection"
+                        checked: false
+                        enabled: includeScreenshotSwitch.checked
+                        onToggled: cropScreenshotToggled(checked)
+                    }
                 }
                 GridLayout {
                     columns: 2
@@ -266,7 +434,7 @@ ApplicationWindow {
 
                     Label { text: "Audio" }
                     RowLayout {
-                        enabled: wordText.text != ""
+                        enabled: wordText.text != "" && root.tts_state == "ready"
 
                         MediaPlayer {
                             id: audioPlayer
@@ -352,6 +520,7 @@ ApplicationWindow {
                                             Layout.fillWidth: true
                                             font.pointSize: 18
                                             text: model.reading
+                                            opacity: model.pending ? 0.5 : 1.0  // not in Anki yet
                                         }
                                     }
                                     Label {
@@ -372,4 +541,72 @@ ApplicationWindow {
             }
         }
     }
+
+    /* Tracing debug overlay, toggled with F12 */
+    Shortcut {
+        sequence: "F12"
+        onActivated: traceOverlay.shown = !traceOverlay.shown
+    }
+    Pane {
+        id: traceOverlay
+        property bool shown: true
+        visible: shown && root.trace_stats.length > 0
+        anchors.right: parent.right
+        anchors.top: parent.top
+        opacity: 0.85
+
+        GridLayout {
+            columns: 6
+            columnSpacing: 10
+            rowSpacing: 2
+
+            Repeater {
+                model: ["stage", "count", "p50", "p95", "max", "histogram (1ms…2s)"]
+                Label { text: modelData; font.bold: true; font.pointSize: 8 }
+            }
+            Repeater {
+                model: root.trace_stats
+                delegate: Repeater {
+                    required property var modelData
+                    readonly property var stage: modelData
+                    model: [
+                        stage.name,
+                        stage.count,
+                        stage.p50.toFixed(1) + " ms",
+                        stage.p95.toFixed(1) + " ms",
+                        stage.max.toFixed(1) + " ms",
+                        stage.histogram,
+                    ]
+                    delegate: Loader {
+                        required property var modelData
+                        required property int index
+                        sourceComponent: index < 5 ? statText : statHistogram
+                        property var value: modelData
+                    }
+                }
+            }
+        }
+
+        Component {
+            id: statText
+            Label { text: value; font.pointSize: 8; font.family: "monospace" }
+        }
+        Component {
+            id: statHistogram
+            Row {
+                spacing: 1
+                Repeater {
+                    model: value
+                    Rectangle {
+                        required property int modelData
+                        readonly property int total: value.reduce((a, b) => a + b, 0)
+                        anchors.bottom: parent.bottom
+                        width: 6
+                        height: Math.max(1, 12 * modelData / Math.max(1, total))
+                        color: modelData > 0 ? palette.highlight : palette.mid
+                    }
+                }
+            }
+        }
+    }
 }
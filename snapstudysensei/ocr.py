@@ -1,10 +1,293 @@
+import hashlib
+import os
+import sys
+from collections import OrderedDict
+from importlib import metadata
+from pathlib import Path
+
+import torch
 from manga_ocr import MangaOcr
 from PIL import Image
+from xdg_base_dirs import xdg_cache_home
+
+from snapstudysensei import trace
+
+# Reference set of the backends check (rendered by render_reference_set()):
+# kanji, kana, small kana, long vowels, punctuation and digits
+REFERENCE_SENTENCES = (
+    "日本語",
+    "今日はいい天気ですね",
+    "何をしているの？",
+    "ありがとうございました！",
+    "ちょっと待って…",
+    "コーヒーを飲みましょう",
+    "東京駅まで歩いて１０分です",
+    "「大丈夫、心配しないで」",
+    "やっぱり無理だったか",
+    "ジョッキでビールを頼んだ",
+)
+
+
+def render_reference_set(sentences=REFERENCE_SENTENCES, sizes=(24, 32, 48)) -> list[tuple[str, Image.Image]]:
+    """
+    Synthetic crops along with their text: black text on white, as found in
+    bubbles. A QGuiApplication must exist, for the fonts.
+    """
+    from PySide6.QtGui import QFont, QFontMetrics, QImage, QPainter, Qt
+
+    from snapstudysensei.qimage_view import to_pil
+
+    crops = []
+    for size in sizes:
+        font = QFont()
+        font.setPixelSize(size)
+        metrics = QFontMetrics(font)
+        for sentence in sentences:
+            rect = metrics.boundingRect(sentence).adjusted(-size // 2, -size // 2, size // 2, size // 2)
+            image = QImage(rect.size(), QImage.Format_RGB32)
+            image.fill(Qt.white)
+            painter = QPainter(image)
+            painter.setFont(font)
+            painter.drawText(image.rect(), Qt.AlignCenter, sentence)
+            painter.end()
+            crops.append((sentence, to_pil(image)))
+    return crops
+
+
+class _OCRCache:
+    """
+    LRU cache of OCR results keyed on the content of the image.
+
+    Images are identified by a hash of their pixels. With perceptual
+    matching, an image whose difference hash (dHash) is within a few bits of
+    a cached one is considered identical, which tolerates small changes such
+    as compression noise or a selection off by a pixel. Results can also be
+    persisted on disk (exact matches only), where the least recently used
+    files are removed above max_files, using the file modification time as
+    access time.
+    """
+
+    DHASH_SIZE = 8
+
+    def __init__(self, max_entries: int, perceptual_distance: int | None, cache_dir: Path | None, max_files: int):
+        self._entries: OrderedDict[str, tuple[int, str]] = OrderedDict()
+        self._max_entries = max_entries
+        self._perceptual_distance = perceptual_distance
+        self._cache_dir = cache_dir
+        self._max_files = max_files
+        self._num_files = 0
+        if cache_dir is not None:
+            cache_dir.mkdir(parents=True, exist_ok=True)
+            self._num_files = sum(1 for _ in cache_dir.glob("*.txt"))
+
+    @staticmethod
+    def _get_digest(image: Image.Image) -> str:
+        h = hashlib.blake2b(digest_size=16)
+        h.update(f"{image.mode}:{image.width}x{image.height}:".encode())
+        h.update(image.tobytes())
+        return h.hexdigest()
+
+    @classmethod
+    def _get_dhash(cls, image: Image.Image) -> int:
+        size = cls.DHASH_SIZE
+        small = image.convert("L").resize((size + 1, size), Image.Resampling.BILINEAR)
+        pixels = small.tobytes()
+        dhash = 0
+        for y in range(size):
+            row = pixels[y * (size + 1) : (y + 1) * (size + 1)]
+            for x in range(size):
+                dhash = dhash << 1 | (row[x] > row[x + 1])
+        return dhash
+
+    def get(self, image: Image.Image) -> tuple[str, int, str | None]:
+        """Return the digest and dHash of the image, along with the cached text if any"""
+        digest = self._get_digest(image)
+        dhash = self._get_dhash(image) if self._perceptual_distance is not None else 0
+
+        entry = self._entries.get(digest)
+        if entry is not None:
+            self._entries.move_to_end(digest)
+            return digest, dhash, entry[1]
+
+        if self._perceptual_distance is not None:
+            for key, (entry_dhash, text) in reversed(self._entries.items()):
+                if (dhash ^ entry_dhash).bit_count() <= self._perceptual_distance:
+                    self._entries.move_to_end(key)
+                    return digest, dhash, text
+
+        if self._cache_dir is not None:
+            path = self._cache_dir / f"{digest}.txt"
+            try:
+                text = path.read_text(encoding="utf-8")
+                os.utime(path)
+            except FileNotFoundError:
+                pass
+            else:
+                self._insert(digest, dhash, text)
+                return digest, dhash, text
+
+        return digest, dhash, None
+
+    def _insert(self, digest: str, dhash: int, text: str):
+        self._entries[digest] = (dhash, text)
+        self._entries.move_to_end(digest)
+        while len(self._entries) > self._max_entries:
+            self._entries.popitem(last=False)
+
+    def put(self, digest: str, dhash: int, text: str):
+        self._insert(digest, dhash, text)
+        if self._cache_dir is None:
+            return
+        path = self._cache_dir / f"{digest}.txt"
+        if not path.exists():
+            self._num_files += 1
+        path.write_text(text, encoding="utf-8")
+        if self._num_files > self._max_files:
+            self._evict()
+
+    def _evict(self):
+        # Evict down to 90% of the cap, so that the directory isn't listed on
+        # every new entry once it is full
+        paths = sorted(self._cache_dir.glob("*.txt"), key=lambda p: p.stat().st_mtime_ns)
+        self._num_files = len(paths)
+        for path in paths[: max(0, len(paths) - self._max_files * 9 // 10)]:
+            path.unlink(missing_ok=True)
+            self._num_files -= 1
 
 
 class OCRWrapper:
-    def __init__(self):
-        self._mocr = MangaOcr()
+    # - default: stock Manga OCR model, on GPU if available
+    # - int8: CPU only, with the linear layers dynamically quantized to int8
+    BACKENDS = ("default", "int8")
+    PERSISTENT_CACHE_MAX_FILES = 10000
+
+    def __init__(
+        self,
+        backend: str = "default",
+        num_threads: int | None = None,
+        cache_size: int = 256,
+        perceptual_distance: int | None = None,
+        persistent_cache: bool = False,
+    ):
+        if backend not in self.BACKENDS:
+            raise ValueError(f"unknown OCR backend {backend}")
+        if num_threads is not None:
+            torch.set_num_threads(num_threads)
+
+        self._mocr = self._load_int8() if backend == "int8" else MangaOcr()
+
+        cache_dir = xdg_cache_home() / "SnapStudySensei" / "ocr" / backend if persistent_cache else None
+        self._cache = _OCRCache(cache_size, perceptual_distance, cache_dir, self.PERSISTENT_CACHE_MAX_FILES)
+
+    @staticmethod
+    def _load_int8() -> MangaOcr:
+        """
+        The quantized model is saved to the cache once, so that the following
+        loads skip both the loading of the stock weights and their
+        quantization. It is saved per version of the stack, since it is
+        pickled along with the tokenizer and the image processor.
+        """
+        versions = []
+        for name in ("torch", "transformers", "manga-ocr"):
+            try:
+                versions.append(metadata.version(name))
+            except metadata.PackageNotFoundError:
+                versions.append("unknown")
+        path = xdg_cache_home() / "SnapStudySensei" / "models" / f"manga-ocr-int8-{'-'.join(versions)}.pt"
+        try:
+            return torch.load(path, weights_only=False)  # written by us, below
+        except FileNotFoundError:
+            pass
+        except Exception as e:
+            print(f"unable to load the quantized OCR model, recreating it: {e}", file=sys.stderr)
+
+        mocr = MangaOcr(force_cpu=True)
+        mocr.model = torch.ao.quantization.quantize_dynamic(mocr.model, {torch.nn.Linear}, dtype=torch.qint8)
+        try:
+            path.parent.mkdir(parents=True, exist_ok=True)
+            tmp_path = path.with_suffix(".tmp")
+            torch.save(mocr, tmp_path)
+            os.replace(tmp_path, path)
+        except Exception as e:
+            print(f"unable to save the quantized OCR model: {e}", file=sys.stderr)
+        return mocr
+
+    def warmup(self):
+        """
+        Run a first inference, which is significantly slower than the
+        following ones (allocations, kernels selection)
+        """
+        self._mocr(Image.new("RGB", (64, 64), "white"))
 
     def __call__(self, image: Image.Image) -> str:
-        return self._mocr(image)
+        with trace.span("ocr.cache"):
+            digest, dhash, text = self._cache.get(image)
+        if text is None:
+            with trace.span("ocr.infer", width=image.width, height=image.height):
+                text = self._mocr(image)
+            self._cache.put(digest, dhash, text)
+        return text
+
+
+if __name__ == "__main__":
+    # Check that a backend gives the same text as the stock model, on the
+    # rendered reference set or on the given images, and optionally record
+    # the result: python -m snapstudysensei.ocr int8 [image...] [--record out.json]
+    import argparse
+    import json
+    import platform
+    import time
+
+    from PySide6.QtGui import QGuiApplication
+
+    parser = argparse.ArgumentParser(prog="python -m snapstudysensei.ocr")
+    parser.add_argument("backend", choices=OCRWrapper.BACKENDS[1:])
+    parser.add_argument("images", nargs="*", type=Path, help="reference images (default: rendered reference set)")
+    parser.add_argument("--record", type=Path, help="write the result to this JSON file")
+    args = parser.parse_args()
+
+    app = QGuiApplication(sys.argv[:1])  # noqa: F841 (needed for the fonts)
+    if args.images:
+        crops = [(None, Image.open(path).convert("RGB")) for path in args.images]
+        names = [str(path) for path in args.images]
+    else:
+        crops = render_reference_set()
+        names = [f"{text} ({image.height}px)" for text, image in crops]
+
+    results = {}
+    for backend in ("default", args.backend):
+        start = time.perf_counter()
+        ocr = OCRWrapper(backend=backend, cache_size=0)
+        load_time = time.perf_counter() - start
+        ocr.warmup()
+        start = time.perf_counter()
+        texts = [ocr(image) for _, image in crops]
+        results[backend] = dict(load_s=load_time, infer_s=(time.perf_counter() - start) / len(crops), texts=texts)
+        del ocr
+
+    reference, tested = results["default"]["texts"], results[args.backend]["texts"]
+    mismatches = [
+        dict(image=name, expected=expected, text=text)
+        for name, expected, text in zip(names, reference, tested)
+        if text != expected
+    ]
+    for mismatch in mismatches:
+        print(f"{mismatch['image']}: {mismatch['text']!r} != {mismatch['expected']!r}")
+    for backend, result in results.items():
+        correct = sum(text == truth for (truth, _), text in zip(crops, result["texts"]) if truth is not None)
+        accuracy = f", {correct}/{len(crops)} exact" if not args.images else ""
+        print(f"{backend}: load {result['load_s']:.1f}s, {result['infer_s'] * 1e3:.0f}ms per image{accuracy}")
+    print(f"{len(mismatches)} mismatch(es) out of {len(crops)} images")
+
+    if args.record is not None:
+        record = dict(
+            backend=args.backend,
+            images=names,
+            torch=torch.__version__,
+            machine=platform.machine(),
+            processor=platform.processor(),
+            results=results,
+            mismatches=mismatches,
+        )
+        args.record.write_text(json.dumps(record, indent=2, ensure_ascii=False))
+    sys.exit(bool(mismatches))
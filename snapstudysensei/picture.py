@@ -0,0 +1,78 @@
+import os
+from dataclasses import dataclass
+
+from PySide6.QtCore import QBuffer, QByteArray, QIODevice, QRect, Qt
+from PySide6.QtGui import QImage
+
+from snapstudysensei import trace
+
+
+@dataclass
+class PictureEncoder:
+    """
+    Encoding of the card pictures. QImage is used (rather than QPixmap) so
+    that the encoding can happen outside of the GUI thread.
+    """
+
+    # Maximum width or height of the picture, None to keep the original size
+    max_size: int | None = 1280
+
+    # One of "webp", "jpeg" or "png"
+    format: str = "webp"
+
+    # Between 0 and 100, ignored for PNG
+    quality: int = 85
+
+    # When cropping around the selection, margin added on each side,
+    # relatively to the size of the selection
+    crop_padding: float = 0.5
+
+    SUFFIXES = dict(webp=".webp", jpeg=".jpg", png=".png")
+
+    def __post_init__(self):
+        if self.format not in self.SUFFIXES:
+            raise ValueError(f"unknown picture format {self.format}, expected one of {', '.join(self.SUFFIXES)}")
+        if not 0 <= self.quality <= 100:
+            raise ValueError(f"picture quality {self.quality} is not between 0 and 100")
+        if self.max_size is not None and self.max_size <= 0:
+            raise ValueError(f"picture maximum size {self.max_size} is not positive")
+
+    @classmethod
+    def from_env(cls):
+        """
+        Encoder configured by SSS_PICTURE_FORMAT, SSS_PICTURE_QUALITY and
+        SSS_PICTURE_MAX_SIZE (0 to keep the original size)
+        """
+        kwargs = {}
+        if "SSS_PICTURE_FORMAT" in os.environ:
+            kwargs["format"] = os.environ["SSS_PICTURE_FORMAT"]
+        if "SSS_PICTURE_QUALITY" in os.environ:
+            kwargs["quality"] = int(os.environ["SSS_PICTURE_QUALITY"])
+        if "SSS_PICTURE_MAX_SIZE" in os.environ:
+            kwargs["max_size"] = int(os.environ["SSS_PICTURE_MAX_SIZE"]) or None
+        return cls(**kwargs)
+
+    def crop(self, image: QImage, selection: QRect) -> QImage:
+        """Crop the image around the selection, with padding"""
+        dx = round(selection.width() * self.crop_padding)
+        dy = round(selection.height() * self.crop_padding)
+        rect = selection.adjusted(-dx, -dy, dx, dy).intersected(image.rect())
+        return image.copy(rect)
+
+    @trace.traced("picture.encode")
+    def __call__(self, image: QImage, selection: QRect | None = None) -> tuple[bytes, str]:
+        """Encode the image in memory, and return the data along with the file suffix"""
+        if selection is not None and not selection.isEmpty():
+            image = self.crop(image, selection)
+
+        if self.max_size is not None and max(image.width(), image.height()) > self.max_size:
+            image = image.scaled(self.max_size, self.max_size, Qt.KeepAspectRatio, Qt.SmoothTransformation)
+
+        data = QByteArray()
+        buffer = QBuffer(data)
+        buffer.open(QIODevice.WriteOnly)
+        quality = -1 if self.format == "png" else self.quality
+        if not image.save(buffer, self.format, quality):
+            raise Exception(f"unable to encode picture as {self.format}")
+        buffer.close()
+        return data.data(), self.SUFFIXES[self.format]
@@ -0,0 +1,126 @@
+import sys
+
+import numpy as np
+from PIL import Image
+from PySide6.QtGui import QImage
+
+# 32-bit formats are stored as native-endian words, so their byte order in
+# memory depends on the host
+_LITTLE_ENDIAN = sys.byteorder == "little"
+
+# PIL mode and raw mode (byte order in memory) of the QImage formats which
+# can be read without a conversion on the Qt side
+_PIL_MODES = {
+    QImage.Format_Grayscale8: ("L", "L"),
+    QImage.Format_RGB888: ("RGB", "RGB"),
+    QImage.Format_RGBX8888: ("RGB", "RGBX"),
+    QImage.Format_RGBA8888: ("RGBA", "RGBA"),
+    QImage.Format_RGB32: ("RGB", "BGRX" if _LITTLE_ENDIAN else "XRGB"),
+    QImage.Format_ARGB32: ("RGBA", "BGRA" if _LITTLE_ENDIAN else "ARGB"),
+}
+
+
+class _Bits:
+    """
+    Expose the memory of a QImage (padded lines included) through the NumPy
+    array interface. Arrays created from it reference it, which keeps the
+    QImage, and thus its memory, alive; constBits() alone doesn't.
+    """
+
+    def __init__(self, image: QImage):
+        # Shallow copy: if the caller modifies its image afterwards, Qt
+        # detaches it and the data seen here is left untouched
+        self._image = QImage(image)
+        address = np.frombuffer(self._image.constBits(), np.uint8).ctypes.data
+        self.__array_interface__ = dict(
+            shape=(image.height() * image.bytesPerLine(),),
+            typestr="|u1",
+            data=(address, True),
+            version=3,
+        )
+
+
+def _get_readable(image: QImage) -> QImage:
+    if image.format() in _PIL_MODES:
+        return image
+    return image.convertToFormat(QImage.Format_ARGB32 if image.hasAlphaChannel() else QImage.Format_RGB32)
+
+
+def to_numpy(image: QImage) -> np.ndarray:
+    """
+    Read-only view of the pixels as a height×width×channels array, in RGB(A)
+    order (height×width for grayscale). The pixels are only copied when
+    the format can't be expressed as a strided view.
+    """
+    image = _get_readable(image)
+    bytes_per_pixel = image.depth() // 8
+    pixels = np.ndarray(
+        shape=(image.height(), image.width(), bytes_per_pixel),
+        dtype=np.uint8,
+        buffer=np.asarray(_Bits(image)),
+        strides=(image.bytesPerLine(), bytes_per_pixel, 1),
+    )
+    fmt = image.format()
+    if fmt == QImage.Format_Grayscale8:
+        return pixels[..., 0]
+    if fmt == QImage.Format_RGBX8888:
+        return pixels[..., :3]
+    if fmt == QImage.Format_RGB32:
+        return pixels[..., 2::-1] if _LITTLE_ENDIAN else pixels[..., 1:]
+    if fmt == QImage.Format_ARGB32:
+        # The alpha is on the wrong side of the color channels to be reordered without a copy
+        return pixels[..., [2, 1, 0, 3]] if _LITTLE_ENDIAN else pixels[..., [1, 2, 3, 0]]
+    return pixels
+
+
+def to_pil(image: QImage) -> Image.Image:
+    """
+    Convert to a PIL image (L, RGB or RGBA) without the intermediate
+    encoding of Image.fromqimage(). The pixels are shared when the memory
+    layout matches the PIL mode (grayscale, RGBA8888), otherwise they are
+    unpacked once by PIL.
+    """
+    image = _get_readable(image)
+    mode, rawmode = _PIL_MODES[image.format()]
+    size = (image.width(), image.height())
+    data = np.asarray(_Bits(image))
+    if rawmode == mode:
+        return Image.frombuffer(mode, size, data, "raw", rawmode, image.bytesPerLine(), 1)
+    # frombuffer() would map an RGBX layout as is, giving an RGBX image
+    return Image.frombytes(mode, size, data, "raw", rawmode, image.bytesPerLine(), 1)
+
+
+if __name__ == "__main__":
+    # Check the conversions against Pillow's own, and compare their cost:
+    # python -m snapstudysensei.qimage_view
+    import timeit
+
+    from PySide6.QtCore import Qt
+    from PySide6.QtGui import QColor, QPainter
+
+    def _get_test_image(fmt: QImage.Format) -> QImage:
+        image = QImage(1283, 721, QImage.Format_ARGB32)  # odd width to get padded lines
+        image.fill(QColor(10, 20, 30, 255))
+        painter = QPainter(image)
+        painter.fillRect(100, 50, 300, 200, QColor(200, 100, 50, 255))
+        painter.fillRect(0, 0, 7, 3, Qt.white)
+        painter.end()
+        return image.convertToFormat(fmt)
+
+    failures = 0
+    for fmt in (*_PIL_MODES, QImage.Format_ARGB32_Premultiplied, QImage.Format_RGB16):
+        image = _get_test_image(fmt)
+        expected = Image.fromqimage(image)
+        converted = to_pil(image)
+        array = to_numpy(image)
+        reference_mode = {2: "L", 3: "RGB", 4: "RGBA"}[array.ndim if array.ndim == 2 else array.shape[2]]
+        ok = (
+            converted.mode == reference_mode
+            and converted.convert("RGBA").tobytes() == expected.convert("RGBA").tobytes()
+            and np.array_equal(array, np.asarray(expected.convert(reference_mode)))
+        )
+        failures += not ok
+        ref = min(timeit.repeat(lambda: Image.fromqimage(image), number=10, repeat=3)) / 10
+        cur = min(timeit.repeat(lambda: to_pil(image), number=10, repeat=3)) / 10
+        print(f"{fmt.name}: {'ok' if ok else 'MISMATCH'}, fromqimage {ref * 1e3:.2f}ms, to_pil {cur * 1e3:.2f}ms")
+    sys.exit(failures != 0)
@@ -1,24 +1,88 @@
-from PySide6.QtCore import QSize, Qt, Signal
-from PySide6.QtGui import QPixmap, QWindow
+from PySide6.QtCore import QRect, QSize, Qt, Signal
+from PySide6.QtGui import QImage
 from PySide6.QtQuick import QQuickImageProvider
 
+from snapstudysensei import trace
+from snapstudysensei.x11_capture import X11Capture
+
+
+class SnapshotStore:
+    """
+    Full resolution frame of the last snapshot, along with a pyramid of
+    downscaled versions for display: each display size is cached, and a new
+    one is scaled from the smallest cached image still larger than it rather
+    than from the full frame.
+
+    The images handed out are implicitly shared with the store, so they cost
+    nothing until modified; being QImage, they can be used from any thread.
+    """
+
+    def __init__(self):
+        self._frame = QImage()
+        self._displays: dict[tuple[int, int], QImage] = {}
+
+    def set(self, frame: QImage):
+        self.release()
+        self._frame = frame
+
+    @property
+    def frame(self) -> QImage:
+        return self._frame
+
+    def isNull(self) -> bool:
+        return self._frame.isNull()
+
+    def crop(self, rect: QRect) -> QImage:
+        return self._frame.copy(rect)
+
+    def get_display(self, max_size: QSize) -> QImage:
+        """Image fitting in the given size (never upscaled)"""
+        size = self._frame.size()
+        if size.width() <= max_size.width() and size.height() <= max_size.height():
+            return self._frame
+        size = size.scaled(max_size, Qt.KeepAspectRatio)
+
+        key = (size.width(), size.height())
+        display = self._displays.get(key)
+        if display is None:
+            larger = [image for image in self._displays.values() if image.width() >= size.width()]
+            source = min(larger, key=QImage.width, default=self._frame)
+            display = source.scaled(size, Qt.IgnoreAspectRatio, Qt.SmoothTransformation)
+            self._displays[key] = display
+        return display
+
+    def release(self, keep_frame: bool = False):
+        """Free the display images, and the frame itself unless keep_frame is set"""
+        self._displays.clear()
+        if not keep_frame:
+            self._frame = QImage()
+
+    def memory_usage(self) -> int:
+        """Size (in bytes) of all the images currently held for the snapshot"""
+        return sum(image.sizeInBytes() for image in (self._frame, *self._displays.values()) if not image.isNull())
+
 
 class SnapshotProvider(QQuickImageProvider):
-    snapshotTaken = Signal(QPixmap)
+    snapshotTaken = Signal()
+
+    DISPLAY_SIZE = QSize(640, 480)
 
     def __init__(self):
-        super().__init__(QQuickImageProvider.Pixmap)
+        super().__init__(QQuickImageProvider.Image)
+        self._capture = X11Capture()
+        self.store = SnapshotStore()
 
-    def requestPixmap(self, id: str, size: QSize, requestedSize: QSize) -> QPixmap:
+    def requestImage(self, id: str, size: QSize, requestedSize: QSize) -> QImage:
         wid = int(id)
-        window = QWindow.fromWinId(wid)
-        pixmap = window.screen().grabWindow(window.winId())
-        if pixmap.isNull():
-            return pixmap
-
-        self.snapshotTaken.emit(pixmap)
+        # The grabbed image is the one and only full resolution copy, shared
+        # with the rest of the application through the store
+        with trace.span("capture.snapshot"):
+            image = self._capture.grab(wid, detach=True)
+        if image.isNull():
+            return image
 
-        width = min(pixmap.width(), 640)
-        height = min(pixmap.height(), 480)
-        pixmap = pixmap.scaled(width, height, Qt.KeepAspectRatio)
-        return pixmap
+        self.store.set(image)
+        with trace.span("capture.display"):
+            display = self.store.get_display(self.DISPLAY_SIZE)
+        self.snapshotTaken.emit()
+        return display
@@ -0,0 +1,167 @@
+"""
+Lightweight tracing of the processing stages.
+
+Tracing is enabled with the SSS_TRACE environment variable; when set to a
+file path (anything other than "1"), a Chrome trace (chrome://tracing,
+Perfetto) is written to it at exit. The variable is read once at import:
+when tracing is disabled, span() returns a shared no-op context manager
+and traced() leaves the functions untouched.
+"""
+
+import atexit
+import json
+import os
+import threading
+import time
+from collections import deque
+from functools import wraps
+
+_SETTING = os.environ.get("SSS_TRACE", "")
+ENABLED = _SETTING not in ("", "0")
+
+# Number of events kept for the Chrome trace, and of durations kept per
+# stage for the statistics
+MAX_EVENTS = 100_000
+HISTORY = 256
+
+# Upper bounds (ms) of the histogram buckets, the last one being unbounded
+HISTOGRAM_BOUNDS = (1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000)
+
+
+class _Tracer:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._origin = time.perf_counter_ns()
+        self._events: deque[tuple] = deque(maxlen=MAX_EVENTS)
+        self._durations: dict[str, deque[int]] = {}
+        self._counts: dict[str, int] = {}
+        self._thread_names: dict[int, str] = {}
+
+    def record(self, name: str, start: int, end: int, args: dict):
+        tid = threading.get_ident()
+        with self._lock:
+            if tid not in self._thread_names:
+                self._thread_names[tid] = threading.current_thread().name
+            self._events.append((name, start, end - start, tid, args))
+            durations = self._durations.get(name)
+            if durations is None:
+                durations = self._durations[name] = deque(maxlen=HISTORY)
+            durations.append(end - start)
+            self._counts[name] = self._counts.get(name, 0) + 1
+
+    def get_stats(self) -> list[dict]:
+        with self._lock:
+            snapshot = {name: (sorted(durations), self._counts[name]) for name, durations in self._durations.items()}
+        stats = []
+        for name, (durations, count) in sorted(snapshot.items()):
+            durations_ms = [duration / 1e6 for duration in durations]
+            histogram = [0] * (len(HISTOGRAM_BOUNDS) + 1)
+            bucket = 0
+            for duration in durations_ms:  # sorted, so the bucket only moves forward
+                while bucket < len(HISTOGRAM_BOUNDS) and duration >= HISTOGRAM_BOUNDS[bucket]:
+                    bucket += 1
+                histogram[bucket] += 1
+            stats.append(
+                dict(
+                    name=name,
+                    count=count,
+                    p50=durations_ms[len(durations_ms) // 2],
+                    p95=durations_ms[min(len(durations_ms) - 1, len(durations_ms) * 95 // 100)],
+                    max=durations_ms[-1],
+                    histogram=histogram,
+                )
+            )
+        return stats
+
+    def export(self, path: str):
+        with self._lock:
+            events = list(self._events)
+            thread_names = dict(self._thread_names)
+        pid = os.getpid()
+        trace_events = [
+            dict(name="thread_name", ph="M", pid=pid, tid=tid, args=dict(name=name))
+            for tid, name in thread_names.items()
+        ]
+        for name, start, duration, tid, args in events:
+            event = dict(
+                name=name,
+                cat=name.split(".", 1)[0],
+                ph="X",
+                ts=(start - self._origin) / 1e3,
+                dur=duration / 1e3,
+                pid=pid,
+                tid=tid,
+            )
+            if args:
+                event["args"] = args
+            trace_events.append(event)
+        with open(path, "w") as f:
+            json.dump(dict(traceEvents=trace_events, displayTimeUnit="ms"), f)
+
+
+class _Span:
+    __slots__ = ("_name", "_args", "_start")
+
+    def __init__(self, name: str, args: dict):
+        self._name = name
+        self._args = args
+
+    def __enter__(self):
+        self._start = time.perf_counter_ns()
+        return self
+
+    def __exit__(self, *exc_info):
+        _tracer.record(self._name, self._start, time.perf_counter_ns(), self._args)
+
+
+class _NullSpan:
+    __slots__ = ()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        pass
+
+
+_NULL_SPAN = _NullSpan()
+_tracer = _Tracer() if ENABLED else None
+
+
+def span(name: str, **args):
+    """Context manager measuring a stage; args are attached to the Chrome trace event"""
+    if _tracer is None:
+        return _NULL_SPAN
+    return _Span(name, args)
+
+
+def traced(name: str):
+    """Decorator measuring every call of a function as a stage"""
+
+    def decorator(func):
+        if _tracer is None:
+            return func
+
+        @wraps(func)
+        def wrapper(*args, **kwargs):
+            with _Span(name, {}):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def get_stats() -> list[dict]:
+    """Statistics (in ms) over the last durations of each stage"""
+    return _tracer.get_stats() if _tracer is not None else []
+
+
+def export(path: str):
+    """Write the recorded events in the Chrome trace format"""
+    if _tracer is not None:
+        _tracer.export(path)
+
+
+if ENABLED and _SETTING != "1":
+    atexit.register(export, _SETTING)
@@ -1,59 +1,215 @@
-import tempfile
+import hashlib
+import io
+import os
+import threading
 import urllib
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
 from urllib.parse import quote
-from urllib.request import urlretrieve
+from urllib.request import urlopen
 
 from gtts import gTTS
+from xdg_base_dirs import xdg_cache_home
+
+from snapstudysensei import trace
+
+
+class _AudioCache:
+    """
+    On-disk cache of the audio files, content-addressed by (method, word,
+    reading). Entries without audio are recorded as empty ".none" files.
+    The least recently used entries are removed when the total size goes
+    above the cap, using the file modification time as access time.
+    """
+
+    def __init__(self, path: Path, max_size: int):
+        self._dir = path
+        self._dir.mkdir(parents=True, exist_ok=True)
+        self._max_size = max_size
+        self._lock = threading.Lock()
+        self._size = sum(f.stat().st_size for f in self._dir.iterdir())
+
+    def _get_paths(self, key: tuple[str, str, str]) -> tuple[Path, Path]:
+        digest = hashlib.sha256("\0".join(key).encode("utf-8")).hexdigest()
+        return self._dir / f"{digest}.mp3", self._dir / f"{digest}.none"
+
+    def get(self, key: tuple[str, str, str]) -> tuple[bool, Path | None]:
+        """Return whether the entry is cached, and its path (None if there is no audio)"""
+        path, none_path = self._get_paths(key)
+        # Under the lock, so that the entry isn't evicted between its lookup
+        # and its touch, which makes it the most recently used one
+        with self._lock:
+            for entry_path in (path, none_path):
+                try:
+                    os.utime(entry_path)
+                except FileNotFoundError:
+                    continue
+                return True, path if entry_path == path else None
+        return False, None
+
+    def put(self, key: tuple[str, str, str], data: bytes | None) -> Path | None:
+        path, none_path = self._get_paths(key)
+        entry_path = path if data is not None else none_path
+        tmp_path = entry_path.with_suffix(f".tmp{threading.get_ident()}")
+        tmp_path.write_bytes(data or b"")
+        with self._lock:
+            try:
+                self._size -= entry_path.stat().st_size
+            except FileNotFoundError:
+                pass
+            os.replace(tmp_path, entry_path)
+            self._size += len(data or b"")
+            self._evict(keep=entry_path)
+        return path if data is not None else None
+
+    def _evict(self, keep: Path):
+        if self._size <= self._max_size:
+            return
+        entries = sorted(self._dir.iterdir(), key=lambda f: f.stat().st_mtime_ns)
+        for entry_path in entries:
+            if self._size <= self._max_size:
+                break
+            if entry_path == keep or ".tmp" in entry_path.suffix:
+                continue
+            self._size -= entry_path.stat().st_size
+            entry_path.unlink()
 
 
 class TTSWrapper:
+    CACHE_MAX_SIZE = 256 * 1024 * 1024
+    POD101_URL = "https://assets.languagepod101.com/dictionary/japanese/audiomp3.php"
+
+    # Seconds to wait for the audio servers, a stalled fetch holds one of the
+    # workers until then
+    TIMEOUT = 10
+
+    # Methods fetched in advance when a word is picked
+    PREFETCH_METHODS = ("google-kanji", "google-reading", "pod101")
+    MAX_WORKERS = 4
+
+    # SHA-256 of the clip served by Pod101 when it has no audio for a word
+    # ("the audio for this clip is currently not available...")
+    POD101_NO_AUDIO_HASH = "ae6398b5a27bc8c0a771df6c907ade794be15518174773c58c7c7ddd17098906"
+
     def __init__(self):
-        self._tempfile = Path(tempfile.gettempdir()) / "SnapStudySensei.mp3"
+        self._cache = _AudioCache(xdg_cache_home() / "SnapStudySensei" / "tts", self.CACHE_MAX_SIZE)
 
-        # Cache only the last entry
-        self._last_key: tuple[str, str, str] | None = None
-        self._last_value: Path | None = None
+        # In-flight fetches, so that a prefetched entry isn't requested twice
+        self._executor = ThreadPoolExecutor(max_workers=self.MAX_WORKERS, thread_name_prefix="tts")
+        self._fetches: dict[tuple[str, str, str], Future] = {}
+        self._fetches_lock = threading.Lock()
 
         self._method = "none"
         self.set_method(self._method)
 
-    def set_method(self, method: str):
-        self._func = {
+    def _get_func(self, method: str):
+        return {
             "google-kanji": self._google_kanji,
             "google-reading": self._google_reading,
             "pod101": self._pod101,
             "none": self._none,
         }[method]
+
+    def set_method(self, method: str):
+        self._func = self._get_func(method)
         self._method = method
 
-    def _none(self, word: str, reading: str) -> Path | None:
+    def _none(self, word: str, reading: str) -> bytes | None:
         return None
 
-    def _google_kanji(self, word: str, reading: str) -> Path | None:
-        tts = gTTS(word, lang="ja")
-        tts.save(self._tempfile)
-        return self._tempfile
+    def _gtts(self, text: str) -> bytes:
+        with io.BytesIO() as f:
+            gTTS(text, lang="ja", timeout=self.TIMEOUT).write_to_fp(f)
+            return f.getvalue()
+
+    def _google_kanji(self, word: str, reading: str) -> bytes | None:
+        return self._gtts(word)
 
-    def _google_reading(self, word: str, reading: str) -> Path | None:
-        tts = gTTS(reading, lang="ja")
-        tts.save(self._tempfile)
-        return self._tempfile
+    def _google_reading(self, word: str, reading: str) -> bytes | None:
+        return self._gtts(reading)
 
-    def _pod101(self, word: str, reading: str) -> Path | None:
+    def _pod101(self, word: str, reading: str) -> bytes | None:
         word = quote(word)
         reading = quote(reading)
-        url = f"https://assets.languagepod101.com/dictionary/japanese/audiomp3.php?kanji={word}&kana={reading}"
-        urlretrieve(url, self._tempfile)
-        return self._tempfile
+        url = f"{self.POD101_URL}?kanji={word}&kana={reading}"
+        with urlopen(url, timeout=self.TIMEOUT) as response:
+            data = response.read()
+        if not data or hashlib.sha256(data).hexdigest() == self.POD101_NO_AUDIO_HASH:
+            return None
+        return data
 
-    def __call__(self, word: str, reading: str) -> Path | None:
+    def _get(self, method: str, word: str, reading: str) -> Path | None:
+        if method == "none":
+            return None
         if not reading:
             reading = word
-        key = (self._method, word, reading)
-        if self._last_key is not None and self._last_key == key:
-            return self._last_value
-        ret = self._func(word, reading)
-        self._last_key = key
-        self._last_value = ret
-        return ret
+        key = (method, word, reading)
+        cached, path = self._cache.get(key)
+        if cached:
+            return path
+        with trace.span("tts.fetch", method=method):
+            data = self._get_func(method)(word, reading)
+        return self._cache.put(key, data)
+
+    def fetch(self, method: str, word: str, reading: str) -> Future:
+        """Asynchronously get the audio path of an entry for the given method"""
+        key = (method, word, reading)
+        with self._fetches_lock:
+            future = self._fetches.get(key)
+            if future is not None:
+                return future
+            future = self._executor.submit(self._get, method, word, reading)
+            self._fetches[key] = future
+        future.add_done_callback(lambda _: self._fetch_done(key))
+        return future
+
+    def _fetch_done(self, key: tuple[str, str, str]):
+        # Once done, the entry is in the on-disk cache (unless it failed)
+        with self._fetches_lock:
+            self._fetches.pop(key, None)
+
+    def prefetch(self, word: str, reading: str) -> dict[str, Future]:
+        """Start fetching the audio of an entry for all the prefetch methods"""
+        return {method: self.fetch(method, word, reading) for method in self.PREFETCH_METHODS}
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False, cancel_futures=True)
+
+    def __call__(self, word: str, reading: str) -> Path | None:
+        return self._get(self._method, word, reading)
+
+
+if __name__ == "__main__":
+    # Check the fetches against a local stand-in of Pod101:
+    # python -m snapstudysensei.tts
+    import tempfile
+
+    from snapstudysensei.fake_servers import FakeAudioServer
+
+    os.environ["XDG_CACHE_HOME"] = tempfile.mkdtemp()
+    no_audio = b"no audio clip"
+    server = FakeAudioServer(dict(猫=b"neko clip"), no_audio=no_audio, stalled={"犬"})
+    tts = TTSWrapper()
+    tts.POD101_URL = f"{server.url}/audiomp3.php"
+    tts.POD101_NO_AUDIO_HASH = hashlib.sha256(no_audio).hexdigest()
+    tts.TIMEOUT = 0.5
+
+    path = tts.fetch("pod101", "猫", "ねこ").result()
+    assert path.read_bytes() == b"neko clip"
+    assert tts.fetch("pod101", "猫", "ねこ").result() == path
+    assert server.requests == 1, "the cached entry was fetched again"
+    assert tts.fetch("pod101", "鳥", "とり").result() is None, "the no audio clip was taken as audio"
+
+    # Concurrent fetches of an entry are made once
+    futures = [tts.fetch("pod101", "魚", "さかな") for _ in range(3)]
+    assert len(set(futures)) == 1
+    futures[0].result()
+    assert server.requests == 3
+
+    # A stalled server doesn't hold the worker
+    error = tts.fetch("pod101", "犬", "いぬ").exception(timeout=5)
+    assert isinstance(error, TimeoutError), "the fetch did not time out"
+
+    tts.shutdown()
+    server.close()
+    print("ok")
@@ -1,28 +1,83 @@
-from PySide6.QtCore import Property, QObject, Qt, Signal, Slot
-from PySide6.QtGui import QWindow
+import hashlib
+import time
+from collections import deque
+
+import PySide6
+from PySide6.QtCore import Property, QObject, Qt, QTimer, Signal, Slot
+from PySide6.QtGui import QImage
 from PySide6.QtMultimedia import QVideoFrame, QVideoFrameFormat, QVideoSink
 from PySide6.QtQml import QmlElement
 
+from snapstudysensei import trace
+from snapstudysensei.x11_capture import X11Capture
+
 QML_IMPORT_NAME = "SnapStudySensei"
 QML_IMPORT_MAJOR_VERSION = 1
 
+# Qt 6.8 can create a video frame directly from a QImage
+HAS_IMAGE_FRAMES = PySide6.__version_info__ >= (6, 8)
+
+
+def _copy_rows(dst, dst_linesize: int, src, src_linesize: int, height: int):
+    copy_linesize = min(dst_linesize, src_linesize)
+    for y in range(height):
+        dst_start = y * dst_linesize
+        src_start = y * src_linesize
+        dst[dst_start : dst_start + copy_linesize] = src[src_start : src_start + copy_linesize]
+
 
 @QmlElement
 class WindowCaptureProducer(QObject):
     widChanged = Signal()
     videoSinkChanged = Signal()
+    activeChanged = Signal()
+    mappedChanged = Signal()
+    adaptiveChanged = Signal()
+    effectiveFpsChanged = Signal()
+
+    # Capture interval bounds (ms); in adaptive mode, the interval grows by
+    # BACKOFF every time the content didn't change, up to MAX_INTERVAL
+    MIN_INTERVAL = 100
+    MAX_INTERVAL = 1000
+    BACKOFF = 1.5
+
+    # Duration (s) over which the effective frame rate is measured
+    FPS_WINDOW = 2.0
 
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
 
         self._wid = None
         self._video_sink = None
+        self._capture = X11Capture()
+
+        self._active = True
+        self._mapped = True
+        self._adaptive = True
+        self._timer = QTimer(self)
+        self._timer.setInterval(self.MIN_INTERVAL)
+        self._timer.timeout.connect(self._tick)
+
+        # Change detection and effective frame rate
+        self._last_digest = None
+        self._publish_times = deque()
+        self._effective_fps = 0.0
+
+        # Frames are reused while their format doesn't change, alternating
+        # between two of them so that the one currently displayed is not
+        # overwritten
+        self._frames_format = None
+        self._frames = []
+        self._frame_index = 0
 
     def _get_wid(self) -> int | None:
         return self._wid
 
     def _set_wid(self, wid: int | None):
         self._wid = wid
+        self._last_digest = None
+        self._timer.setInterval(self.MIN_INTERVAL)
+        self._update_timer()
         self.widChanged.emit()
 
     wid = Property(int, _get_wid, _set_wid, notify=widChanged)
@@ -33,37 +88,150 @@ class WindowCaptureProducer(QObject):
 
     def _set_videoSink(self, video_sink: QVideoSink):
         self._video_sink = video_sink
+        self._update_timer()
 
     videoSink = Property(QObject, _get_videoSink, _set_videoSink, notify=videoSinkChanged)
 
+    def _get_active(self) -> bool:
+        return self._active
+
+    def _set_active(self, active: bool):
+        """Captures are paused while inactive (typically when the preview is hidden)"""
+        self._active = active
+        self._update_timer()
+        self.activeChanged.emit()
+
+    active = Property(bool, _get_active, _set_active, notify=activeChanged)
+
+    def _get_mapped(self) -> bool:
+        return self._mapped
+
+    def _set_mapped(self, mapped: bool):
+        """
+        Captures are also paused while the window is unmapped (e.g.
+        minimized), since its content can't be grabbed; they resume at full
+        rate once it is mapped again
+        """
+        if mapped == self._mapped:
+            return
+        self._mapped = mapped
+        self._timer.setInterval(self.MIN_INTERVAL)
+        self._update_timer()
+        self.mappedChanged.emit()
+
+    mapped = Property(bool, _get_mapped, _set_mapped, notify=mappedChanged)
+
+    def _get_adaptive(self) -> bool:
+        return self._adaptive
+
+    def _set_adaptive(self, adaptive: bool):
+        self._adaptive = adaptive
+        self._timer.setInterval(self.MIN_INTERVAL)
+        self.adaptiveChanged.emit()
+
+    adaptive = Property(bool, _get_adaptive, _set_adaptive, notify=adaptiveChanged)
+
+    def _get_effectiveFps(self) -> float:
+        return self._effective_fps
+
+    effectiveFps = Property(float, _get_effectiveFps, notify=effectiveFpsChanged)
+
+    def _update_timer(self):
+        if self._active and self._mapped and self._wid is not None and self._video_sink is not None:
+            if not self._timer.isActive():
+                self._timer.start()
+        else:
+            self._timer.stop()
+            self._update_effective_fps()
+
+    def _update_effective_fps(self):
+        now = time.monotonic()
+        while self._publish_times and now - self._publish_times[0] > self.FPS_WINDOW:
+            self._publish_times.popleft()
+        fps = len(self._publish_times) / self.FPS_WINDOW
+        if fps != self._effective_fps:
+            self._effective_fps = fps
+            self.effectiveFpsChanged.emit()
+
     @Slot()
-    def refresh(self):
+    def _tick(self):
+        published = self.refresh()
+        if self._adaptive:
+            # Back off while the source is static (or can't be grabbed) and
+            # go back to full rate on change
+            interval = self.MIN_INTERVAL if published else round(self._timer.interval() * self.BACKOFF)
+            self._timer.setInterval(min(interval, self.MAX_INTERVAL))
+        self._update_effective_fps()
+
+    @Slot(result=bool)
+    @trace.traced("capture.preview")
+    def refresh(self) -> bool:
+        """Grab the window and publish a frame if its content changed; return whether it did"""
         if self._wid is None or self._video_sink is None:
-            return
+            return False
 
-        window = QWindow.fromWinId(self._wid)
-        pixmap = window.screen().grabWindow(window.winId())
-        if pixmap.isNull():
-            return
+        image = self._capture.grab(self._wid)
+        if image.isNull():
+            return False
+
+        # Scaling also detaches the image from the capture buffer
+        image = image.scaled(240, 180, Qt.KeepAspectRatio)
+
+        digest = hashlib.blake2b(image.constBits(), digest_size=16).digest()
+        if digest == self._last_digest:
+            return False
+        self._last_digest = digest
+
+        self._video_sink.setVideoFrame(self._get_frame(image))
+        self._publish_times.append(time.monotonic())
+        return True
 
-        pixmap = pixmap.scaled(240, 180, Qt.KeepAspectRatio)
-        image = pixmap.toImage()
+    def _get_frame(self, image: QImage) -> QVideoFrame:
+        if HAS_IMAGE_FRAMES:
+            return QVideoFrame(image)
 
         pixel_format = QVideoFrameFormat.pixelFormatFromImageFormat(image.format())
         frame_format = QVideoFrameFormat(image.size(), pixel_format)
-        frame = QVideoFrame(frame_format)
+        if self._frames_format != frame_format:
+            self._frames_format = frame_format
+            self._frames = [QVideoFrame(frame_format) for _ in range(2)]
+        frame = self._frames[self._frame_index]
+        self._frame_index ^= 1
 
-        # Memcpy from image to video frame
+        # Memcpy from image to video frame, at once when the line sizes match
         frame.map(QVideoFrame.WriteOnly)
         dst = frame.bits(0)
-        src = image.bits()
+        src = image.constBits()
         dst_linesize = frame.bytesPerLine(0)
         src_linesize = image.bytesPerLine()
-        copy_linesize = min(dst_linesize, src_linesize)
-        for y in range(image.height()):
-            dst_start = y * dst_linesize
-            src_start = y * src_linesize
-            dst[dst_start : dst_start + copy_linesize] = src[src_start : src_start + copy_linesize]
+        if dst_linesize == src_linesize:
+            size = src_linesize * image.height()
+            dst[:size] = src[:size]
+        else:
+            _copy_rows(dst, dst_linesize, src, src_linesize, image.height())
+        frame.unmap()
+        return frame
+
+
+if __name__ == "__main__":
+    # Per-frame cost of the copy into a video frame:
+    # python -m snapstudysensei.window_capture
+    import timeit
+
+    image = QImage(240, 180, QImage.Format_RGB32)
+    image.fill(Qt.darkCyan)
+    pixel_format = QVideoFrameFormat.pixelFormatFromImageFormat(image.format())
+    frame_format = QVideoFrameFormat(image.size(), pixel_format)
+
+    def _row_copy():
+        frame = QVideoFrame(frame_format)
+        frame.map(QVideoFrame.WriteOnly)
+        _copy_rows(frame.bits(0), frame.bytesPerLine(0), image.constBits(), image.bytesPerLine(), image.height())
         frame.unmap()
 
-        self._video_sink.setVideoFrame(frame)
+    producer = WindowCaptureProducer()
+    benchmarks = dict(rows=_row_copy, current=lambda: producer._get_frame(image))
+    for name, func in benchmarks.items():
+        number = 1000
+        duration = min(timeit.repeat(func, number=number, repeat=5)) / number
+        print(f"{name}: {duration * 1e6:.1f}µs per frame")
@@ -3,10 +3,21 @@ import xcffib.xproto
 
 
 class WindowsList:
+    """
+    List of the client windows along with their title and visibility.
+
+    Besides full queries, the list can be kept up to date from the X events:
+    once watched, changes of the clients list, of the window titles and of
+    their mapping are reported by process_events().
+    """
+
     def __init__(self):
         self._xcb = xcffib.connect()
         self._atom_client_list = self._xcb_get_atom("_NET_CLIENT_LIST")
         self._atom_wm_name = self._xcb_get_atom("_NET_WM_NAME")
+        self._roots = [screen.root for screen in self._xcb.get_setup().roots]
+        self._windows: dict[int, tuple[str, bool]] = {}
+        self._watching = False
 
     def _xcb_get_atom(self, name: str) -> int:
         return self._xcb.core.InternAtom(only_if_exists=False, name=name, name_len=len(name)).reply().atom
@@ -19,15 +30,105 @@ class WindowsList:
             type=xcffib.xproto.GetPropertyType.Any,
             long_offset=0,
             long_length=0xFFFFFFFF,
-        ).reply()
+        )
 
-    def __call__(self) -> dict[int, tuple[str, bool]]:
+    def _get_client_ids(self) -> list[int]:
+        cookies = [self._xcb_get_prop(root, self._atom_client_list) for root in self._roots]
+        return [wid for cookie in cookies for wid in cookie.reply().value.to_atoms()]
+
+    def _query(self, wids) -> dict[int, tuple[str, bool]]:
+        """Get the title and visibility of the windows, without waiting for each reply in turn"""
+        cookies = [
+            (wid, self._xcb.core.GetWindowAttributes(wid), self._xcb_get_prop(wid, self._atom_wm_name)) for wid in wids
+        ]
         windows = {}
-        for screen in self._xcb.get_setup().roots:
-            children = self._xcb_get_prop(screen.root, self._atom_client_list).value.to_atoms()
-            for wid in children:
-                window_attrs = self._xcb.core.GetWindowAttributes(wid).reply()
-                viewable = window_attrs.map_state == xcffib.xproto.MapState.Viewable
-                window_title = self._xcb_get_prop(wid, self._atom_wm_name).value.to_utf8()
-                windows[wid] = (window_title, viewable)
+        for wid, attrs_cookie, title_cookie in cookies:
+            try:
+                window_attrs = attrs_cookie.reply()
+                window_title = title_cookie.reply().value.to_utf8()
+            except xcffib.xproto.WindowError:
+                # The window was destroyed in the meantime
+                continue
+            viewable = window_attrs.map_state == xcffib.xproto.MapState.Viewable
+            windows[wid] = (window_title, viewable)
         return windows
+
+    def _select_events(self, wids):
+        mask = xcffib.xproto.EventMask.PropertyChange | xcffib.xproto.EventMask.StructureNotify
+        for wid in wids:
+            self._xcb.core.ChangeWindowAttributes(wid, xcffib.xproto.CW.EventMask, [mask])
+        self._xcb.flush()
+
+    def _update(self, windows: dict[int, tuple[str, bool]], removed) -> tuple[dict[int, tuple[str, bool]], list[int]]:
+        """Merge the new state of some windows, and return what actually changed"""
+        removed = [wid for wid in removed if self._windows.pop(wid, None) is not None]
+        changed = {wid: window for wid, window in windows.items() if self._windows.get(wid) != window}
+        self._windows.update(changed)
+        return changed, removed
+
+    def fileno(self) -> int:
+        return self._xcb.get_file_descriptor()
+
+    def watch(self):
+        """Subscribe to the changes of the clients list and of every client window"""
+        for root in self._roots:
+            self._xcb.core.ChangeWindowAttributes(
+                root, xcffib.xproto.CW.EventMask, [xcffib.xproto.EventMask.PropertyChange]
+            )
+        self._select_events(self._windows)
+        self._watching = True
+
+    def refresh(self) -> tuple[dict[int, tuple[str, bool]], list[int]]:
+        """Query all the windows, and return the changed entries along with the removed ids"""
+        windows = self._query(self._get_client_ids())
+        if self._watching:
+            self._select_events(windows.keys() - self._windows.keys())
+        return self._update(windows, self._windows.keys() - windows.keys())
+
+    def process_events(self) -> tuple[dict[int, tuple[str, bool]], list[int]]:
+        """Handle the pending X events, and return the changed entries along with the removed ids"""
+        changed, removed = {}, []
+        while True:
+            # Events are coalesced so that a burst of them is handled with a
+            # single batch of requests
+            client_list_changed = False
+            wids = set()
+            while True:
+                try:
+                    event = self._xcb.poll_for_event()
+                except xcffib.Error:
+                    # Typically events selection on a window that was destroyed
+                    continue
+                if event is None:
+                    break
+                if isinstance(event, xcffib.xproto.PropertyNotifyEvent):
+                    if event.atom == self._atom_client_list and event.window in self._roots:
+                        client_list_changed = True
+                    elif event.atom == self._atom_wm_name and event.window in self._windows:
+                        wids.add(event.window)
+                elif isinstance(event, (xcffib.xproto.MapNotifyEvent, xcffib.xproto.UnmapNotifyEvent)):
+                    if event.window in self._windows:
+                        wids.add(event.window)
+            if not client_list_changed and not wids:
+                break
+
+            gone = []
+            if client_list_changed:
+                client_ids = set(self._get_client_ids())
+                new_ids = client_ids - self._windows.keys()
+                self._select_events(new_ids)
+                wids |= new_ids
+                gone = list(self._windows.keys() - client_ids)
+                wids -= set(gone)
+
+            # Waiting for the replies may have queued more events, so loop
+            # until there are none left
+            batch_changed, batch_removed = self._update(self._query(wids), gone)
+            for wid in batch_removed:
+                changed.pop(wid, None)
+            removed = [wid for wid in removed if wid not in batch_changed] + batch_removed
+            changed.update(batch_changed)
+        return changed, removed
+
+    def __call__(self) -> dict[int, tuple[str, bool]]:
+        return self._query(self._get_client_ids())
@@ -0,0 +1,221 @@
+import ctypes
+import ctypes.util
+import sys
+
+import xcffib
+import xcffib.shm
+import xcffib.xproto
+from PySide6.QtGui import QImage, QWindow
+
+_IPC_PRIVATE = 0
+_IPC_CREAT = 0o1000
+_IPC_RMID = 0
+
+_libc = ctypes.CDLL(ctypes.util.find_library("c"), use_errno=True)
+_libc.shmget.argtypes = (ctypes.c_int, ctypes.c_size_t, ctypes.c_int)
+_libc.shmget.restype = ctypes.c_int
+_libc.shmat.argtypes = (ctypes.c_int, ctypes.c_void_p, ctypes.c_int)
+_libc.shmat.restype = ctypes.c_void_p
+_libc.shmdt.argtypes = (ctypes.c_void_p,)
+_libc.shmdt.restype = ctypes.c_int
+_libc.shmctl.argtypes = (ctypes.c_int, ctypes.c_int, ctypes.c_void_p)
+_libc.shmctl.restype = ctypes.c_int
+
+
+class _UnsupportedImage(Exception):
+    pass
+
+
+class _SharedSegment:
+    """
+    System V shared memory segment attached to both this process and the X
+    server. The segment is marked for removal as soon as the server is
+    attached, so that it is reclaimed by the kernel even if we crash.
+    """
+
+    def __init__(self, xcb, shm, size: int):
+        shmid = _libc.shmget(_IPC_PRIVATE, size, _IPC_CREAT | 0o600)
+        if shmid < 0:
+            raise OSError(ctypes.get_errno(), "shmget failed")
+        addr = _libc.shmat(shmid, None, 0)
+        if addr in (None, ctypes.c_void_p(-1).value):
+            _libc.shmctl(shmid, _IPC_RMID, None)
+            raise OSError(ctypes.get_errno(), "shmat failed")
+
+        self._shm = shm
+        self._addr = addr
+        self.size = size
+        self.buffer = (ctypes.c_char * size).from_address(addr)
+        self.seg = xcb.generate_id()
+        try:
+            shm.Attach(self.seg, shmid, False, is_checked=True).check()
+        except Exception:
+            _libc.shmdt(addr)
+            raise
+        finally:
+            _libc.shmctl(shmid, _IPC_RMID, None)
+
+    def close(self):
+        self._shm.Detach(self.seg)
+        _libc.shmdt(self._addr)
+
+
+class X11Capture:
+    """
+    Window grabber reading the window content straight into a shared memory
+    buffer with the MIT-SHM extension, which saves the transfer of the
+    pixels through the X socket. The buffer is reused between the grabs and
+    only reallocated when a larger window is grabbed.
+
+    When the extension is not available (remote display, Wayland, ...) or
+    the window can't be read this way, the Qt path is used instead.
+    """
+
+    def __init__(self):
+        self._xcb = None
+        self._shm = None
+        self._segment = None
+        try:
+            self._xcb = xcffib.connect()
+            name = "MIT-SHM"
+            if self._xcb.core.QueryExtension(len(name), name).reply().present:
+                self._shm = self._xcb(xcffib.shm.key)
+                self._shm.QueryVersion().reply()
+        except Exception as e:
+            print(f"MIT-SHM unavailable, falling back to Qt capture: {e}", file=sys.stderr)
+            self._shm = None
+
+    @property
+    def has_shm(self) -> bool:
+        return self._shm is not None
+
+    def _get_segment(self, size: int) -> _SharedSegment:
+        if self._segment is None or self._segment.size < size:
+            if self._segment is not None:
+                self._segment.close()
+                self._segment = None
+            self._segment = _SharedSegment(self._xcb, self._shm, size)
+        return self._segment
+
+    def _grab_shm(self, wid: int) -> QImage:
+        geometry = self._xcb.core.GetGeometry(wid).reply()
+        if geometry.depth not in (24, 32):
+            raise _UnsupportedImage(f"unsupported depth {geometry.depth}")
+        width, height = geometry.width, geometry.height
+        segment = self._get_segment(width * height * 4)
+        self._shm.GetImage(
+            wid, 0, 0, width, height, 0xFFFFFFFF, xcffib.xproto.ImageFormat.ZPixmap, segment.seg, 0
+        ).reply()
+        # 32-bit ZPixmap are BGRX in memory on little endian, which is what
+        # RGB32 is; the alpha of the 32-bit visuals is ignored
+        return QImage(segment.buffer, width, height, width * 4, QImage.Format_RGB32)
+
+    @staticmethod
+    def _grab_qt(wid: int) -> QImage:
+        window = QWindow.fromWinId(wid)
+        return window.screen().grabWindow(window.winId()).toImage()
+
+    def grab(self, wid: int, detach: bool = False) -> QImage:
+        """
+        Grab the content of a window (a null image if it can't be grabbed).
+        With MIT-SHM, the returned image points to the shared buffer: it is
+        only valid until the next grab, unless detach is set, in which case
+        it is copied (the Qt path always returns an image of its own).
+        """
+        if self._shm is not None:
+            try:
+                image = self._grab_shm(wid)
+                return image.copy() if detach else image
+            except (xcffib.XcffibException, _UnsupportedImage):
+                # Typically BadMatch on unmapped or partially off-screen
+                # windows, or 16/30-bit visuals, which the Qt path deals with
+                pass
+            except OSError as e:
+                # The shared memory can't be allocated (limits reached,
+                # sandbox), which won't change for the next grabs
+                print(f"MIT-SHM capture failed, falling back to Qt capture: {e}", file=sys.stderr)
+                self._segment = None
+                self._shm = None
+        return self._grab_qt(wid)
+
+    def close(self):
+        if self._segment is not None:
+            self._segment.close()
+            self._segment = None
+        if self._xcb is not None:
+            self._xcb.disconnect()
+            self._xcb = None
+            self._shm = None
+
+
+if __name__ == "__main__":
+    # Check that both paths read the pixels of a window with a known
+    # content, and time them. With --xvfb, the check is run on a virtual
+    # display of its own, which only needs Xvfb to be installed:
+    # python -m snapstudysensei.x11_capture [--xvfb]
+    import os
+    import subprocess
+    import timeit
+
+    xvfb = None
+    if "--xvfb" in sys.argv[1:]:
+        xvfb = subprocess.Popen(["Xvfb", "-displayfd", "1", "-screen", "0", "1024x768x24"], stdout=subprocess.PIPE)
+        os.environ["DISPLAY"] = ":" + xvfb.stdout.readline().decode().strip()
+        os.environ["QT_QPA_PLATFORM"] = "xcb"
+
+    from PySide6.QtCore import QRect, Qt
+    from PySide6.QtGui import QGuiApplication, QPainter, QRasterWindow
+    from PySide6.QtTest import QTest
+
+    COLORS = (Qt.red, Qt.green, Qt.blue, Qt.white)
+
+    def paint_pattern(painter: QPainter, width: int, height: int):
+        stripe = width // len(COLORS)
+        for i, color in enumerate(COLORS):
+            painter.fillRect(QRect(i * stripe, 0, stripe, height), color)
+
+    class PatternWindow(QRasterWindow):
+        def paintEvent(self, event):
+            paint_pattern(QPainter(self), self.width(), self.height())
+
+    try:
+        app = QGuiApplication(sys.argv)
+        window = PatternWindow()
+        window.resize(320, 240)
+        window.show()
+        if not QTest.qWaitForWindowExposed(window):
+            sys.exit("the test window wasn't shown")
+        QTest.qWait(200)  # let it be painted
+        wid = int(window.winId())
+
+        expected = QImage(window.width(), window.height(), QImage.Format_RGB32)
+        paint_pattern(QPainter(expected), expected.width(), expected.height())
+
+        capture = X11Capture()
+        if not capture.has_shm:
+            sys.exit("MIT-SHM not available")
+        failures = 0
+        for name, image in dict(
+            shm=capture._grab_shm(wid).copy(), qt=X11Capture._grab_qt(wid).convertToFormat(QImage.Format_RGB32)
+        ).items():
+            same = image == expected
+            failures += not same
+            print(f"{name}: {image.width()}x{image.height()}, {'expected pixels' if same else 'pixels differ'}")
+
+        # Unmapped windows can't be read through MIT-SHM, the Qt path is used
+        window.hide()
+        QTest.qWait(200)
+        capture.grab(wid)
+        window.show()
+        QTest.qWaitForWindowExposed(window)
+
+        for name, func in dict(shm=lambda: capture._grab_shm(wid), qt=lambda: X11Capture._grab_qt(wid)).items():
+            number = 20
+            duration = min(timeit.repeat(func, number=number, repeat=3)) / number
+            print(f"{name}: {duration * 1e3:.2f}ms per grab")
+
+        capture.close()
+    finally:
+        if xvfb is not None:
+            xvfb.terminate()
+    sys.exit(failures != 0)